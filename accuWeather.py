@@ -1,13 +1,18 @@
+import logging
 import sqlite3
 from datetime import datetime
-from file_functions import get_api_data
+from file_functions import get_cached_api_data
+from parsers import parse_owm_weather
+import api_config
+import streaming
+from db import unit_of_work
+
+logger = logging.getLogger(__name__)
 
 def get_city_weather(city):
     """Get weather data for a city."""
-    from file_functions import get_api_data
-    api_token = "3c3f7d2d9f242452b9c1389c3172c412"
-    request_url = f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={api_token}"
-    return get_api_data(request_url)
+    from file_functions import get_cached_api_data
+    return get_cached_api_data('openweathermap', city, api_config.owm_weather_url(city))
 
 def create_weather_table(db_cursor):
     """Create the weather data table in the database."""
@@ -25,7 +30,11 @@ def create_weather_table(db_cursor):
     ''')
 
 def insert_weather_data(db_cursor, city_data_list):
-    """Insert weather data into the database."""
+    """Insert weather data into the database in one unit of work."""
+    with unit_of_work(db_cursor.connection):
+        _insert_weather_rows(db_cursor, city_data_list)
+
+def _insert_weather_rows(db_cursor, city_data_list):
     for city_data in city_data_list:
         city, temperature, description, timestamp, humidity, wind_speed = city_data
         
@@ -34,36 +43,38 @@ def insert_weather_data(db_cursor, city_data_list):
         ''', (city, timestamp))
         
         if db_cursor.fetchone():
-            print(f"Skipping {city} for timestamp {timestamp}: Data already exists.")
+            logger.debug("Skipping %s for timestamp %s: Data already exists.", city, timestamp)
         else:
             db_cursor.execute('''
             INSERT OR IGNORE INTO city_weather (city, temperature, weather_description, timestamp, humidity, wind_speed)
             VALUES (?, ?, ?, ?, ?, ?)
             ''', (city, temperature, description, timestamp, humidity, wind_speed))
-            print(f"Inserted {city} weather data for timestamp {timestamp}.")
-    
-    db_cursor.connection.commit()
+            logger.debug("Inserted %s weather data for timestamp %s.", city, timestamp)
 
-def get_multiple_city_weather(city_requests, db_cursor):
-    """Retrieve and insert weather data for multiple cities."""
-    all_city_data = []
+def fetch_and_parse_city_weather(city):
+    """Fetch and parse one city's current weather (runs on a pipeline worker thread)."""
+    logger.debug("Fetching weather data for %s...", city)
+    return parse_owm_weather(None, get_city_weather(city))
 
-    for city in city_requests:
-        print(f"Fetching weather data for {city}...")
-        weather_data = get_city_weather(city)
-        
-        if weather_data and weather_data.get('cod') == 200:
-            city_name = city
-            temperature = weather_data['main']['temp'] - 273.15  # Convert from Kelvin to Celsius
-            description = weather_data['weather'][0]['description']
-            timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            humidity = weather_data['main']['humidity']
-            wind_speed = weather_data['wind']['speed']
-
-            city_data_tuple = (city_name, temperature, description, timestamp, humidity, wind_speed)
-            all_city_data.append(city_data_tuple)
-        else:
-            print(f"Failed to retrieve data for {city}.")
+def get_multiple_city_weather(city_requests, db_cursor, max_workers=8,
+                              flush_rows=streaming.FLUSH_ROWS, flush_seconds=streaming.FLUSH_SECONDS):
+    """Retrieve and insert weather data for multiple cities.
 
-    if all_city_data:
-        insert_weather_data(db_cursor, all_city_data)
+    Cities are fetched and parsed on worker threads (see streaming.bounded_map)
+    and written in micro-batches, so memory stays flat however many cities
+    are requested.
+    """
+    with streaming.MicroBatcher(lambda rows: insert_weather_data(db_cursor, rows), flush_rows,
+                                flush_seconds) as batcher:
+        for result in streaming.bounded_map(fetch_and_parse_city_weather, city_requests, max_workers,
+                                            idle_timeout=flush_seconds):
+            if result is streaming.IDLE:
+                batcher.tick()
+                continue
+            city, record = result
+            if record:
+                timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+                batcher.add((city, record.temperature, record.weather_description, timestamp,
+                             record.humidity, record.wind_speed))
+            else:
+                logger.info("Failed to retrieve data for %s.", city)
@@ -0,0 +1,241 @@
+import numpy as np
+
+import instrumentation
+
+# Columns loaded for every paired observation, in array column order
+METRICS = ('aqi', 'forecasted_pm25_avg', 'forecasted_pm10_avg', 'forecasted_o3_avg',
+           'humidity', 'wind_speed', 'temperature')
+# Percentiles stored per city and metric
+PERCENTILES = (10, 25, 50, 75, 90)
+# Observations per rolling window (one observation per fetch, so 24 is a day of hourly runs)
+ROLLING_WINDOW = 24
+# city_id used in metric_correlations for correlations over all cities together
+ALL_CITIES = 0
+
+# Keep only numeric values; older rows can hold WAQI's '-' placeholder
+_NUMERIC = "CASE WHEN typeof({0}) IN ('integer', 'real') THEN {0} END"
+
+
+def create_statistics_tables(db_cursor):
+    """Create the per-city metric statistics and metric correlation tables."""
+    db_cursor.execute('''
+    CREATE TABLE IF NOT EXISTS city_metric_statistics (
+        city_id INTEGER,
+        metric TEXT,
+        sample_count INTEGER,
+        mean REAL,
+        std REAL,
+        p10 REAL,
+        p25 REAL,
+        median REAL,
+        p75 REAL,
+        p90 REAL,
+        rolling_mean REAL,
+        PRIMARY KEY (city_id, metric),
+        FOREIGN KEY(city_id) REFERENCES cities(id)
+    )
+    ''')
+    db_cursor.execute('''
+    CREATE TABLE IF NOT EXISTS metric_correlations (
+        city_id INTEGER,
+        metric_a TEXT,
+        metric_b TEXT,
+        correlation REAL,
+        sample_count INTEGER,
+        PRIMARY KEY (city_id, metric_a, metric_b)
+    )
+    ''')
+
+
+def load_observations(db_cursor):
+    """Load paired AQI and weather observations into arrays sorted by city.
+
+    AQI and weather rows are paired on (city_id, batch_id). Returns (city_ids, values): an int64 array with one
+    city id per observation and a contiguous float64 array with one column per
+    entry of METRICS, NaN where a value is missing.
+    """
+    aqi_columns = ', '.join(_NUMERIC.format(f'a.{metric}') for metric in METRICS[:4])
+    weather_columns = ', '.join(_NUMERIC.format(f'w.{metric}') for metric in METRICS[4:])
+    db_cursor.execute(f'''
+    SELECT a.city_id, a.batch_id, {aqi_columns}, {weather_columns}
+    FROM city_aqi_data a
+    JOIN city_weather_data w ON w.city_id = a.city_id AND w.batch_id = a.batch_id
+    ORDER BY a.city_id, a.batch_id
+    ''')
+    rows = np.array(db_cursor.fetchall(), dtype=np.float64).reshape(-1, 2 + len(METRICS))
+    return rows[:, 0].astype(np.int64), np.ascontiguousarray(rows[:, 2:])
+
+
+def group_bounds(city_ids):
+    """Return (unique city ids, start offset of each city) for an array sorted by city."""
+    return np.unique(city_ids, return_index=True)
+
+
+def grouped_mean_std(values, starts):
+    """Per-group count, mean and population standard deviation of each column, ignoring NaN."""
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0.0)
+    counts = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+    sums = np.add.reduceat(filled, starts, axis=0)
+    squares = np.add.reduceat(filled * filled, starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        variances = np.maximum(squares / counts - means * means, 0.0)
+    return counts, means, np.sqrt(variances)
+
+
+def grouped_percentiles(values, starts, percentiles=PERCENTILES):
+    """Per-group percentiles of each column (linear interpolation, NaN ignored).
+
+    All columns are sorted in one pass by (group, value): each value is scaled
+    into [0, 0.5] and offset by its group number, with NaN at 0.75 so it sorts
+    last inside its group. The sort key only orders rows; percentiles are
+    interpolated from the original values. Returns an array of shape
+    (groups, len(percentiles), columns).
+    """
+    size, columns = values.shape
+    group_index = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, size)))[:, None]
+    valid = ~np.isnan(values)
+    low = np.nanmin(np.where(valid, values, np.inf), axis=0)
+    span = np.nanmax(np.where(valid, values, -np.inf), axis=0) - low
+    span[~(span > 0)] = 1.0
+    with np.errstate(invalid='ignore'):
+        keys = np.where(valid, (values - low) / span * 0.5, 0.75) + group_index
+    ordered = np.take_along_axis(values, np.argsort(keys, axis=0), axis=0)
+
+    counts = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+    last = (counts - 1).clip(min=0)
+    column_index = np.arange(columns)
+    result = np.full((len(starts), len(percentiles), columns), np.nan)
+    for i, percentile in enumerate(percentiles):
+        position = last * (percentile / 100)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, last)
+        low_values = ordered[starts[:, None] + lower, column_index]
+        high_values = ordered[starts[:, None] + upper, column_index]
+        result[:, i, :] = np.where(counts > 0, low_values + (high_values - low_values) * (position - lower), np.nan)
+    return result
+
+
+def rolling_mean(values, starts, window=ROLLING_WINDOW):
+    """Mean of each column over the last `window` observations of the same city, per observation."""
+    size = len(values)
+    valid = ~np.isnan(values)
+    value_sums = np.vstack([np.zeros((1, values.shape[1])), np.cumsum(np.where(valid, values, 0.0), axis=0)])
+    count_sums = np.vstack([np.zeros((1, values.shape[1])), np.cumsum(valid, axis=0)])
+    group_start = np.repeat(starts, np.diff(np.append(starts, size)))
+    first = np.maximum(np.arange(1, size + 1) - window, group_start)
+    last = np.arange(1, size + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (value_sums[last] - value_sums[first]) / (count_sums[last] - count_sums[first])
+
+
+def correlation_matrix(values):
+    """Pearson correlation between every pair of columns over rows where both are present.
+
+    Equivalent to pandas.DataFrame.corr(), computed with a few matrix products.
+    Returns (correlations, pair counts).
+    """
+    valid = (~np.isnan(values)).astype(np.float64)
+    filled = np.where(valid > 0, values, 0.0)
+    pairs = valid.T @ valid
+    sums = filled.T @ valid  # sums[i, j]: sum of column i over rows where j is also present
+    squares = (filled * filled).T @ valid
+    products = filled.T @ filled
+    with np.errstate(invalid='ignore', divide='ignore'):
+        covariance = products - sums * sums.T / pairs
+        variance_a = squares - sums * sums / pairs
+        variance_b = variance_a.T
+        correlations = covariance / np.sqrt(variance_a * variance_b)
+    correlations[pairs < 2] = np.nan
+    return np.clip(correlations, -1.0, 1.0), pairs.astype(np.int64)
+
+
+def grouped_correlations(values, starts):
+    """Per-group Pearson correlation of every column pair, all groups at once.
+
+    Uses only rows where both columns of a pair are present. Each pair needs a
+    few reduceat passes over two columns, so memory stays linear in the number
+    of observations. Returns (correlations, pair counts), each of shape
+    (groups, columns, columns).
+    """
+    columns = values.shape[1]
+    correlations = np.full((len(starts), columns, columns), np.nan)
+    pair_counts = np.zeros((len(starts), columns, columns), dtype=np.int64)
+    for a in range(columns):
+        for b in range(a + 1, columns):
+            both = ~(np.isnan(values[:, a]) | np.isnan(values[:, b]))
+            x = np.where(both, values[:, a], 0.0)
+            y = np.where(both, values[:, b], 0.0)
+            n = np.add.reduceat(both.astype(np.int64), starts)
+            sum_x, sum_y = np.add.reduceat(x, starts), np.add.reduceat(y, starts)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                covariance = np.add.reduceat(x * y, starts) - sum_x * sum_y / n
+                variance_x = np.add.reduceat(x * x, starts) - sum_x * sum_x / n
+                variance_y = np.add.reduceat(y * y, starts) - sum_y * sum_y / n
+                correlation = np.clip(covariance / np.sqrt(variance_x * variance_y), -1.0, 1.0)
+            correlation[n < 2] = np.nan
+            correlations[:, a, b] = correlations[:, b, a] = correlation
+            pair_counts[:, a, b] = pair_counts[:, b, a] = n
+    return correlations, pair_counts
+
+
+def _sql_value(value):
+    return None if np.isnan(value) else float(value)
+
+
+def compute_statistics(city_ids, values, window=ROLLING_WINDOW):
+    """Compute every statistic for loaded observations; returns (statistics rows, correlation rows)."""
+    if len(city_ids) == 0:
+        return [], []
+    groups, starts = group_bounds(city_ids)
+    counts, means, stds = grouped_mean_std(values, starts)
+    percentiles = grouped_percentiles(values, starts)
+    rolling = rolling_mean(values, starts, window)
+    last_rows = np.append(starts[1:], len(city_ids)) - 1
+
+    statistics = []
+    for g, city_id in enumerate(groups.tolist()):
+        for m, metric in enumerate(METRICS):
+            if counts[g, m]:
+                statistics.append((city_id, metric, int(counts[g, m]), _sql_value(means[g, m]),
+                                   _sql_value(stds[g, m]), *map(_sql_value, percentiles[g, :, m]),
+                                   _sql_value(rolling[last_rows[g], m])))
+
+    correlations = []
+    overall, overall_pairs = correlation_matrix(values)
+    per_city, per_city_pairs = grouped_correlations(values, starts)
+    pair_indexes = [(a, b) for a in range(len(METRICS)) for b in range(a + 1, len(METRICS))]
+    for a, b in pair_indexes:
+        if not np.isnan(overall[a, b]):
+            correlations.append((ALL_CITIES, METRICS[a], METRICS[b], float(overall[a, b]), int(overall_pairs[a, b])))
+    for g, city_id in enumerate(groups.tolist()):
+        for a, b in pair_indexes:
+            if not np.isnan(per_city[g, a, b]):
+                correlations.append((city_id, METRICS[a], METRICS[b], float(per_city[g, a, b]),
+                                     int(per_city_pairs[g, a, b])))
+    return statistics, correlations
+
+
+@instrumentation.timed()
+def refresh_statistics(db_cursor, window=ROLLING_WINDOW):
+    """Recompute city_metric_statistics and metric_correlations from all observations.
+
+    Observations are loaded once, every statistic is computed across all cities
+    in a handful of vectorised passes, and both tables are replaced with two
+    executemany calls. The caller commits. Returns the number of cities covered.
+    """
+    city_ids, values = load_observations(db_cursor)
+    statistics, correlations = compute_statistics(city_ids, values, window)
+    db_cursor.execute('DELETE FROM city_metric_statistics')
+    db_cursor.execute('DELETE FROM metric_correlations')
+    db_cursor.executemany('''
+    INSERT INTO city_metric_statistics (city_id, metric, sample_count, mean, std, p10, p25, median, p75, p90,
+        rolling_mean)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', statistics)
+    db_cursor.executemany('''
+    INSERT INTO metric_correlations (city_id, metric_a, metric_b, correlation, sample_count)
+    VALUES (?, ?, ?, ?, ?)
+    ''', correlations)
+    return len(np.unique(city_ids))
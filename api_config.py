@@ -0,0 +1,21 @@
+import os
+
+# Provider base URLs and credentials. The base URLs can be pointed at a local
+# stand-in (see mock_provider_server.py) through the environment or by
+# assigning these names before the first request.
+WAQI_BASE_URL = os.environ.get('WAQI_BASE_URL', 'https://api.waqi.info')
+OWM_BASE_URL = os.environ.get('OWM_BASE_URL', 'https://api.openweathermap.org')
+WAQI_TOKEN = os.environ.get('WAQI_TOKEN', '2f4c73a57b156c067a7fb45fa17784bd26cd0a8f')
+OWM_API_KEY = os.environ.get('OWM_API_KEY', '3c3f7d2d9f242452b9c1389c3172c412')
+
+def waqi_feed_url(city):
+    return f'{WAQI_BASE_URL}/feed/{city}/?token={WAQI_TOKEN}'
+
+def waqi_bounds_url(lat1, lng1, lat2, lng2):
+    return f'{WAQI_BASE_URL}/map/bounds/?latlng={lat1},{lng1},{lat2},{lng2}&token={WAQI_TOKEN}'
+
+def owm_weather_url(city):
+    return f'{OWM_BASE_URL}/data/2.5/weather?q={city}&appid={OWM_API_KEY}'
+
+def owm_group_url(owm_ids):
+    return f'{OWM_BASE_URL}/data/2.5/group?id={",".join(str(owm_id) for owm_id in owm_ids)}&appid={OWM_API_KEY}'
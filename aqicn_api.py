@@ -1,11 +1,17 @@
+import logging
 import sqlite3
-from file_functions import get_api_data
+from file_functions import get_cached_api_data
+from parsers import parse_waqi_feed
 from datetime import datetime
+import api_config
+import streaming
+from db import unit_of_work
+
+logger = logging.getLogger(__name__)
 
 def get_city_aqi(city):
     """Get AQI data for a city."""
-    api_url = f'https://api.waqi.info/feed/{city}/?token=2f4c73a57b156c067a7fb45fa17784bd26cd0a8f'
-    return get_api_data(api_url)
+    return get_cached_api_data('waqi', city, api_config.waqi_feed_url(city))
 
 def create_progress_table(db_cursor):
     """Create a table to store progress information."""
@@ -23,13 +29,13 @@ def read_progress(db_cursor):
     return result[0] if result else 0 
 
 def update_progress(db_cursor, index):
-    """Update the progress in the database."""
-    db_cursor.execute('''
-    INSERT OR REPLACE INTO progress (key, value)
-    VALUES ("last_processed_index", ?)
-    ''', (index,))
-    db_cursor.connection.commit()
-    print(f"Progress saved at city index: {index}")
+    """Update the progress in the database (committed with the caller's unit of work, if any)."""
+    with unit_of_work(db_cursor.connection):
+        db_cursor.execute('''
+        INSERT OR REPLACE INTO progress (key, value)
+        VALUES ("last_processed_index", ?)
+        ''', (index,))
+    logger.debug("Progress saved at city index: %d", index)
 
 def create_aqi_table(db_cursor):
     """Create the AQI table in the database."""
@@ -71,52 +77,67 @@ def get_pollutant_value(db_cursor, pollutant):
     result = db_cursor.fetchone()
     return result[0] if result else None
 
-def get_multiple_city_aqi(city_requests, db_cursor):
-    """Retrieve and insert AQI data for multiple cities in batches of 25."""
+def fetch_and_parse_city_aqi(city):
+    """Fetch and parse one city's AQI feed (runs on a pipeline worker thread)."""
+    logger.debug("Fetching AQI data for %s...", city)
+    return parse_waqi_feed(None, get_city_aqi(city))
+
+def get_multiple_city_aqi(city_requests, db_cursor, batch_size=25, max_workers=8,
+                          flush_rows=streaming.FLUSH_ROWS, flush_seconds=streaming.FLUSH_SECONDS):
+    """Retrieve and insert AQI data for the next batch_size cities that return data.
+
+    Cities are fetched and parsed on worker threads (see streaming.bounded_map)
+    and written in micro-batches; each micro-batch is committed together with
+    the progress marker, so a failure only repeats the cities after the last
+    flush.
+    """
     start_index = read_progress(db_cursor)
-    print(f"Starting from city index: {start_index}")
-    
-    all_city_data = []
-    
-    for i, city in enumerate(city_requests[start_index:], start=start_index):
-        if len(all_city_data) >= 25:  # Process only 25 cities at a time
-            break
-        
-        print(f"Fetching AQI data for {city}...")
-        city_data = get_api_data(f'https://api.waqi.info/feed/{city}/?token=2f4c73a57b156c067a7fb45fa17784bd26cd0a8f')
-
-        if city_data and city_data.get('status') == 'ok':
-            city_name = city
-            aqi = city_data['data']['aqi']
-            dominant_pollutant = city_data['data'].get('dominentpol', 'N/A')
-            dominant_pollutant_value = get_pollutant_value(db_cursor, dominant_pollutant)
-
-            # Set timestamp to the current time
-            timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-
-            forecast_pm25 = city_data['data']['forecast']['daily']['pm25'][0]
-            forecast_pm25_avg = forecast_pm25.get('avg', 0)
-            forecast_pm10 = city_data['data']['forecast']['daily']['pm10'][0]
-            forecast_pm10_avg = forecast_pm10.get('avg', 0)
-            forecast_o3 = city_data['data']['forecast']['daily']['o3'][0]
-            forecast_o3_avg = forecast_o3.get('avg', 0)
-            
-            city_data_tuple = (
-                city_name, aqi, timestamp, dominant_pollutant_value,
-                forecast_pm25_avg, forecast_pm10_avg, forecast_o3_avg
-            )
-            all_city_data.append(city_data_tuple)
-        else:
-            print(f"Failed to retrieve data for {city}.")
-    
-    if all_city_data:
-        insert_aqi_data(db_cursor, all_city_data)
-    
-    # Update progress after batch processing
-    update_progress(db_cursor, i + 1)
+    logger.info("Starting from city index: %d", start_index)
+    progress = {'next_index': start_index, 'stored_index': start_index, 'collected': 0}
+
+    def write(rows):
+        # The micro-batch's rows and its progress marker are committed together
+        with unit_of_work(db_cursor.connection):
+            insert_aqi_data(db_cursor, rows)
+            update_progress(db_cursor, progress['next_index'])
+        progress['stored_index'] = progress['next_index']
+
+    items = enumerate(city_requests[start_index:], start=start_index)
+    with streaming.MicroBatcher(write, flush_rows, flush_seconds) as batcher:
+        for result in streaming.bounded_map(lambda item: fetch_and_parse_city_aqi(item[1]), items, max_workers,
+                                            idle_timeout=flush_seconds):
+            if result is streaming.IDLE:
+                batcher.tick()
+                continue
+            (i, city), record = result
+            progress['next_index'] = i + 1
+            if record:
+                dominant_pollutant_value = get_pollutant_value(db_cursor, record.dominant_pollutant)
+
+                # Set timestamp to the current time
+                timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+                # Missing forecast series are stored as NULL instead of failing the batch
+                batcher.add((
+                    city, record.aqi, timestamp, dominant_pollutant_value,
+                    record.forecasted_pm25_avg, record.forecasted_pm10_avg, record.forecasted_o3_avg
+                ))
+                progress['collected'] += 1
+                if progress['collected'] >= batch_size:  # Process only batch_size cities at a time
+                    break
+            else:
+                logger.info("Failed to retrieve data for %s.", city)
+
+    # Cities after the last stored row that all failed still advance the progress marker
+    if progress['next_index'] != progress['stored_index']:
+        update_progress(db_cursor, progress['next_index'])
 
 def insert_aqi_data(db_cursor, city_data_list):
-    """Insert AQI data for a list of cities."""
+    """Insert AQI data for a list of cities in one unit of work."""
+    with unit_of_work(db_cursor.connection):
+        _insert_aqi_rows(db_cursor, city_data_list)
+
+def _insert_aqi_rows(db_cursor, city_data_list):
     for city_data in city_data_list:
         city, aqi, timestamp, dominant_pollutant, forecast_pm25_avg, forecast_pm10_avg, forecast_o3_avg = city_data
 
@@ -125,12 +146,10 @@ def insert_aqi_data(db_cursor, city_data_list):
         ''', (city, timestamp))
         
         if db_cursor.fetchone():
-            print(f"Skipping {city} for timestamp {timestamp}: Data already exists.")
+            logger.debug("Skipping %s for timestamp %s: Data already exists.", city, timestamp)
         else:
             db_cursor.execute('''
             INSERT OR IGNORE INTO city_aqi (city, aqi, timestamp, dominant_pollutant, forecast_pm25_avg, forecast_pm10_avg, forecast_o3_avg)
             VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (city, aqi, timestamp, dominant_pollutant, forecast_pm25_avg, forecast_pm10_avg, forecast_o3_avg))
-            print(f"Inserted {city} data for timestamp {timestamp}.")
-    
-    db_cursor.connection.commit()
+            logger.debug("Inserted %s data for timestamp %s.", city, timestamp)
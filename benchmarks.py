@@ -0,0 +1,363 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import analytics
+import api_config
+import http_client
+import response_cache
+import sharded_ingest
+import visualizations
+from calculations import calculate_and_store_average_temperature_for_pollutant_1, refresh_observation_summary
+from db import close_pools, connect_db, unit_of_work
+from file_functions import (create_combined_tables, get_multiple_city_combined_data, insert_combined_data,
+                            resolve_city_ids)
+from migrations import ensure_schema
+from mock_provider_server import owm_weather_payload, start_mock_server, waqi_feed_payload
+from parsers import AqiRecord, CombinedRecord, WeatherRecord, loads, orjson, parse_owm_weather, parse_waqi_feed
+from timeseries import owm_observed_at, waqi_observed_at
+
+PIPELINE_SIZES = (100, 1000, 10000)
+BASELINE_PATH = 'benchmark_baseline.json'
+# A stage slower than baseline by more than this fraction is reported as a regression
+REGRESSION_THRESHOLD = 0.2
+
+
+def make_synthetic_cities(count, seed=0):
+    """Build `count` synthetic city names with (city_data, weather_data)-shaped payloads."""
+    rng = random.Random(seed)
+    pollutants = ["pm25", "pm10", "o3"]
+    descriptions = ["clear sky", "haze", "mist", "few clouds", "broken clouds"]
+    cities = []
+    for i in range(count):
+        observed_at = 1700000000 + i
+        city_data = {
+            'observed_at': observed_at,
+            'aqi': rng.randint(5, 300),
+            'dominant_pollutant': rng.choice(pollutants),
+            'forecasted_pm25_avg': rng.randint(5, 200),
+            'forecasted_pm10_avg': rng.randint(5, 100),
+            'forecasted_o3_avg': rng.randint(1, 60)
+        }
+        weather_data = {
+            'observed_at': observed_at,
+            'temperature': rng.uniform(-20, 40),
+            'weather_description': rng.choice(descriptions),
+            'humidity': rng.randint(10, 100),
+            'wind_speed': rng.uniform(0, 15)
+        }
+        cities.append((f"City {i}", city_data, weather_data))
+    return cities
+
+
+def _insert_combined_data_per_row(db_cursor, cities):
+    """The original ingest path: per-city id lookups and one INSERT per row."""
+    for name, city_data, weather_data in cities:
+        db_cursor.execute('INSERT OR IGNORE INTO cities (name) VALUES (?)', (name,))
+        db_cursor.execute('SELECT id FROM cities WHERE name = ?', (name,))
+        city_id = db_cursor.fetchone()[0]
+
+        db_cursor.execute('SELECT id FROM pollutants WHERE name = ?', (city_data['dominant_pollutant'],))
+        pollutant_id = db_cursor.fetchone()
+        db_cursor.execute('''
+        INSERT INTO city_aqi_data (city_id, observed_at, aqi, dominant_pollutant, forecasted_pm25_avg,
+            forecasted_pm10_avg, forecasted_o3_avg)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (city_id, city_data['observed_at'], city_data['aqi'], pollutant_id[0] if pollutant_id else None,
+              city_data['forecasted_pm25_avg'], city_data['forecasted_pm10_avg'], city_data['forecasted_o3_avg']))
+
+        db_cursor.execute('SELECT id FROM weather_conditions WHERE description = ?',
+                          (weather_data['weather_description'],))
+        condition_id = db_cursor.fetchone()
+        db_cursor.execute('''
+        INSERT INTO city_weather_data (city_id, observed_at, temperature, weather_description, humidity, wind_speed)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (city_id, weather_data['observed_at'], weather_data['temperature'], condition_id[0] if condition_id else None,
+              weather_data['humidity'], weather_data['wind_speed']))
+    db_cursor.connection.commit()
+
+
+def _insert_combined_data_bulk(db_cursor, cities):
+    """The bulk ingest path used by get_multiple_city_combined_data."""
+    city_ids = resolve_city_ids(db_cursor, [name for name, _, _ in cities])
+    combined_data = [
+        CombinedRecord(AqiRecord(city_ids[name], **city_data), WeatherRecord(city_ids[name], **weather_data))
+        for name, city_data, weather_data in cities
+    ]
+    insert_combined_data(db_cursor, combined_data)
+
+
+def _time_ingest(ingest, cities, db_dir):
+    db_path = os.path.join(db_dir, f"{ingest.__name__}.db")
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        create_combined_tables(cursor)
+        start = time.perf_counter()
+        ingest(cursor, cities)
+        return time.perf_counter() - start
+
+
+def bench_ingest(count=10000):
+    """Compare rows/second of the per-row and bulk ingest paths on `count` synthetic cities."""
+    cities = make_synthetic_cities(count)
+    rows = 2 * count  # one AQI row and one weather row per city
+    results = {}
+    with tempfile.TemporaryDirectory() as db_dir:
+        for ingest in (_insert_combined_data_per_row, _insert_combined_data_bulk):
+            elapsed = _time_ingest(ingest, cities, db_dir)
+            results[ingest.__name__.strip('_')] = rows / elapsed
+            print(f"{ingest.__name__.strip('_'):35} {elapsed:8.3f} s  {rows / elapsed:12,.0f} rows/s")
+    print(f"Speed-up: {results['insert_combined_data_bulk'] / results['insert_combined_data_per_row']:.1f}x")
+    return results
+
+
+def _parse_nested(city_id, aqi_data, weather_data):
+    """The original parse path: nested dict lookups building a dict of dicts."""
+    if aqi_data and aqi_data.get('status') == 'ok' and weather_data and weather_data.get('cod') == 200:
+        return {
+            'city_data': {
+                'city_id': city_id,
+                'observed_at': waqi_observed_at(aqi_data['data']),
+                'aqi': aqi_data['data']['aqi'],
+                'dominant_pollutant': aqi_data['data'].get('dominentpol', 'pm25'),
+                'forecasted_pm25_avg': aqi_data['data']['forecast']['daily']['pm25'][0].get('avg', 0),
+                'forecasted_pm10_avg': aqi_data['data']['forecast']['daily']['pm10'][0].get('avg', 0),
+                'forecasted_o3_avg': aqi_data['data']['forecast']['daily']['o3'][0].get('avg', 0)
+            },
+            'weather_data': {
+                'city_id': city_id,
+                'observed_at': owm_observed_at(weather_data),
+                'temperature': weather_data['main']['temp'] - 273.15,
+                'weather_description': weather_data['weather'][0]['description'],
+                'humidity': weather_data['main']['humidity'],
+                'wind_speed': weather_data['wind']['speed']
+            }
+        }
+    return None
+
+
+def _parse_records(city_id, aqi_data, weather_data):
+    """The parsers path used by build_combined_city_data."""
+    aqi = parse_waqi_feed(city_id, aqi_data)
+    weather = parse_owm_weather(city_id, weather_data)
+    if aqi is None or weather is None:
+        return None
+    return CombinedRecord(aqi, weather)
+
+
+def bench_parse(count=10000, repeat=5):
+    """Compare decode and parse cost per city of the nested-dict and record paths on mock payloads.
+
+    The nested path copies fields unchecked and raises on the first missing
+    key; the record path also validates and converts every field, so it is
+    not expected to be cheaper. The ratio shows what that safety costs.
+    """
+    now = int(time.time())
+    raw = [(json.dumps(waqi_feed_payload(f"City {i}", now)).encode('utf-8'),
+            json.dumps(owm_weather_payload(f"City {i}", now)).encode('utf-8')) for i in range(count)]
+    decoders = [('json', json.loads)] + ([('orjson', loads)] if orjson is not None else [])
+    results = {}
+    for name, decode in decoders:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            decoded = [(decode(aqi), decode(weather)) for aqi, weather in raw]
+        results[f'decode_{name}'] = (time.perf_counter() - start) / (repeat * count)
+    for parse in (_parse_nested, _parse_records):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for city_id, (aqi_data, weather_data) in enumerate(decoded):
+                parse(city_id, aqi_data, weather_data)
+        results[parse.__name__.strip('_')] = (time.perf_counter() - start) / (repeat * count)
+    for name, seconds in results.items():
+        print(f"{name:20} {seconds * 1e6:8.2f} us/city")
+    print(f"Records vs nested: {results['parse_records'] / results['parse_nested']:.2f}x the parse cost")
+    return results
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MiB (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+@contextlib.contextmanager
+def _working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def _run_pipeline(count, batch_size, concurrency, plots, workers=1):
+    """Run ingest, averages, statistics and (optionally) plots for `count` mock cities in the current directory."""
+    city_requests = [f"Benchmark City {i}" for i in range(count)]
+    timings = {}
+    with contextlib.closing(connect_db()) as conn:
+        cursor = conn.cursor()
+        ensure_schema(cursor)
+
+        start = time.perf_counter()
+        remaining = count
+        try:
+            while remaining:
+                if workers > 1:
+                    fetched, remaining = sharded_ingest.get_sharded_city_combined_data(
+                        city_requests, cursor, workers, batch_size=batch_size, concurrency=concurrency)
+                else:
+                    fetched, remaining = get_multiple_city_combined_data(city_requests, cursor, batch_size=batch_size,
+                                                                         concurrency=concurrency)
+                if not fetched:
+                    break
+        finally:
+            sharded_ingest.shutdown_workers()
+        timings['ingest'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with unit_of_work(conn):
+            calculate_and_store_average_temperature_for_pollutant_1(cursor)
+            refresh_observation_summary(cursor)
+        timings['averages'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with unit_of_work(conn):
+            analytics.refresh_statistics(cursor)
+        timings['statistics'] = time.perf_counter() - start
+    if plots:
+        start = time.perf_counter()
+        visualizations.main(force=True)
+        timings['plots'] = time.perf_counter() - start
+        close_pools()
+    return timings
+
+
+def _run_pipeline_isolated(base_url, count, batch_size, concurrency, plots, workers):
+    """Run one pipeline size in a fresh temporary directory; returns (timings, HTTP stats, peak RSS in MiB).
+
+    Meant to run in a process of its own, so the peak RSS is this size's alone.
+    """
+    api_config.WAQI_BASE_URL = api_config.OWM_BASE_URL = base_url
+    with tempfile.TemporaryDirectory() as run_dir, _working_directory(run_dir):
+        try:
+            timings = _run_pipeline(count, batch_size, concurrency, plots, workers)
+        finally:
+            response_cache.close()
+            http_client.close_session()
+    return timings, http_client.get_stats(), peak_rss_mb()
+
+
+def bench_pipeline(sizes=PIPELINE_SIZES, latency=0.0, error_rate=0.0, rate_limit=None, batch_size=500,
+                   concurrency=None, plots=True, workers=1):
+    """Run the full pipeline against the local mock providers at each size.
+
+    Each size runs in a fresh process and temporary directory, so databases,
+    the response cache and plots start empty, and ru_maxrss (which only ever
+    grows within a process) measures that size alone. Returns {size: result}
+    where result holds the per-stage seconds, cities/second of the ingest
+    stage, HTTP p50/p99 latency and peak RSS. workers > 1 ingests through sharded_ingest with that many
+    worker processes (their start-up time is included in the ingest stage).
+    """
+    if isinstance(concurrency, int):
+        concurrency = {'waqi': concurrency, 'openweathermap': concurrency}
+    server = start_mock_server(latency=latency, error_rate=error_rate, rate_limit=rate_limit)
+    # spawn, not fork: a forked child would inherit this process's peak RSS
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    try:
+        for count in sizes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                timings, stats, peak_rss = pool.submit(_run_pipeline_isolated, server.base_url, count, batch_size,
+                                                       concurrency, plots, workers).result()
+            result = dict(timings)
+            result['cities_per_second'] = count / timings['ingest']
+            result['latency_p50_ms'] = stats.get('latency_p50', 0) * 1000
+            result['latency_p99_ms'] = stats.get('latency_p99', 0) * 1000
+            result['peak_rss_mb'] = peak_rss
+            results[str(count)] = result
+            print(f"{count:>6} cities  ingest {timings['ingest']:7.2f} s ({result['cities_per_second']:8,.0f} cities/s)  "
+                  f"averages {timings['averages']:6.3f} s  statistics {timings['statistics']:6.3f} s  plots {timings.get('plots', 0):6.2f} s  "
+                  f"p50 {result['latency_p50_ms']:6.1f} ms  p99 {result['latency_p99_ms']:6.1f} ms  "
+                  f"peak RSS {result['peak_rss_mb']:7.1f} MiB")
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def load_baseline(path=BASELINE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def compare_to_baseline(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """Return a message for every stage that got slower than the baseline by more than `threshold`."""
+    regressions = []
+    for size, result in results.items():
+        for stage in ('ingest', 'averages', 'statistics', 'plots'):
+            before, after = baseline.get(size, {}).get(stage), result.get(stage)
+            if before and after is not None and after > before * (1 + threshold):
+                regressions.append(f"{size} cities: {stage} {before:.3f} s -> {after:.3f} s "
+                                   f"(+{(after / before - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the ingest pipeline.")
+    subparsers = parser.add_subparsers(dest='benchmark')
+    ingest_parser = subparsers.add_parser('ingest', help="per-row vs bulk inserts of synthetic rows")
+    ingest_parser.add_argument('--cities', type=int, default=10000, help="number of synthetic cities")
+    parse_parser = subparsers.add_parser('parse', help="JSON decode and payload parse cost per city")
+    parse_parser.add_argument('--cities', type=int, default=10000, help="number of mock payload pairs")
+    pipeline_parser = subparsers.add_parser('pipeline', help="end-to-end run against the local mock providers")
+    pipeline_parser.add_argument('--sizes', type=int, nargs='+', default=list(PIPELINE_SIZES),
+                                 help="city counts to run (default: %(default)s)")
+    pipeline_parser.add_argument('--latency', type=float, default=0.0, help="mock provider response delay in seconds")
+    pipeline_parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of mock requests failing")
+    pipeline_parser.add_argument('--rate-limit', type=float, default=None, help="mock requests/second before 429s")
+    pipeline_parser.add_argument('--batch-size', type=int, default=500)
+    pipeline_parser.add_argument('--concurrency', type=int, default=None, help="requests in flight per provider")
+    pipeline_parser.add_argument('--workers', type=int, default=1, help="ingest worker processes (sharded ingest)")
+    pipeline_parser.add_argument('--skip-plots', action='store_true')
+    pipeline_parser.add_argument('--baseline', default=BASELINE_PATH, help="baseline file (default: %(default)s)")
+    pipeline_parser.add_argument('--save-baseline', action='store_true', help="store this run as the new baseline")
+    pipeline_parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                                 help="allowed slowdown per stage before failing (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'parse':
+        bench_parse(args.cities)
+    elif args.benchmark == 'pipeline':
+        results = bench_pipeline(args.sizes, args.latency, args.error_rate, args.rate_limit, args.batch_size,
+                                 args.concurrency, plots=not args.skip_plots, workers=args.workers)
+        if args.save_baseline:
+            save_baseline(results, args.baseline)
+            print(f"Baseline saved to {args.baseline}")
+            return
+        regressions = compare_to_baseline(results, load_baseline(args.baseline), args.threshold)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            sys.exit(1)
+    else:
+        bench_ingest(getattr(args, 'cities', 10000))
+
+
+if __name__ == "__main__":
+    main()
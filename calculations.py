@@ -1,33 +1,184 @@
-def calculate_and_store_average_temperature_for_pollutant_1(cursor):
-    """Calculate and store the average temperature for cities with dominant pollutant = 1 (pm25)."""
+import logging
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Weather columns that can be aggregated per pollutant
+WEATHER_METRICS = ('temperature', 'humidity', 'wind_speed')
+
+@instrumentation.timed()
+def refresh_pollutant_summary(cursor, metrics=WEATHER_METRICS, full_rebuild=False):
+    """Fold new city_weather_data rows into the per-pollutant weather averages of city_pollutant_summary.
+
+    Maintained like city_avg_temperature: each (city_id, pollutant, metric) row
+    keeps value_sum, sample_count and the last city_weather_data id it has
+    seen, so only rows inserted since the previous call are read. A city that
+    gets a new dominant pollutant starts that pair from id 0. All pollutants
+    and metrics are folded in by one statement; full_rebuild=True clears the
+    table first.
+    """
+    unknown = set(metrics) - set(WEATHER_METRICS)
+    if unknown:
+        raise ValueError(f"Unknown weather metric(s): {', '.join(sorted(unknown))}")
+    if full_rebuild:
+        cursor.execute('DELETE FROM city_pollutant_summary')
+
+    selects = [f'''
+    SELECT p.city_id, p.pollutant, '{metric}', AVG(w.{metric}), TOTAL(w.{metric}), COUNT(w.{metric}), MAX(w.id)
+    FROM pairs p
+    JOIN city_weather_data w ON w.city_id = p.city_id
+    LEFT JOIN city_pollutant_summary s ON s.city_id = p.city_id AND s.pollutant = p.pollutant AND s.metric = '{metric}'
+    WHERE w.id > COALESCE(s.last_weather_id, 0)
+    GROUP BY p.city_id, p.pollutant
+    ''' for metric in metrics]
+    cursor.execute('''
+    WITH pairs AS (
+        SELECT DISTINCT city_id, dominant_pollutant AS pollutant FROM city_aqi_data WHERE dominant_pollutant IS NOT NULL
+    )
+    INSERT INTO city_pollutant_summary (city_id, pollutant, metric, avg_value, value_sum, sample_count, last_weather_id)
+    ''' + 'UNION ALL'.join(selects) + '''
+    ON CONFLICT(city_id, pollutant, metric) DO UPDATE SET
+        value_sum = COALESCE(value_sum, 0) + excluded.value_sum,
+        sample_count = COALESCE(sample_count, 0) + excluded.sample_count,
+        avg_value = (COALESCE(value_sum, 0) + excluded.value_sum)
+            / NULLIF(COALESCE(sample_count, 0) + excluded.sample_count, 0),
+        last_weather_id = excluded.last_weather_id
+    ''')
+    return cursor.rowcount
+
+def update_average_temperature(cursor, full_rebuild=False):
+    """Fold new city_weather_data rows into the running temperature sums of pm25 cities.
+
+    Each city_avg_temperature row keeps temperature_sum, temperature_count and the
+    last city_weather_data id it has seen, so only rows inserted since the previous
+    call are read. Cities that become pm25-dominant for the first time start from
+    id 0 and pick up their whole history. With full_rebuild=True the table is
+    cleared first and everything is recomputed from scratch.
+    """
+    if full_rebuild:
+        cursor.execute('DELETE FROM city_avg_temperature')
+    cursor.execute('''
+    INSERT INTO city_avg_temperature (city_id, avg_temperature, temperature_sum, temperature_count, last_weather_id)
+    SELECT w.city_id, AVG(w.temperature), TOTAL(w.temperature), COUNT(w.temperature), MAX(w.id)
+    FROM city_weather_data w
+    LEFT JOIN city_avg_temperature a ON a.city_id = w.city_id
+    WHERE w.id > COALESCE(a.last_weather_id, 0)
+      AND w.city_id IN (SELECT city_id FROM city_aqi_data WHERE dominant_pollutant = 1)
+    GROUP BY w.city_id
+    ON CONFLICT(city_id) DO UPDATE SET
+        temperature_sum = COALESCE(temperature_sum, 0) + excluded.temperature_sum,
+        temperature_count = COALESCE(temperature_count, 0) + excluded.temperature_count,
+        avg_temperature = (COALESCE(temperature_sum, 0) + excluded.temperature_sum)
+            / NULLIF(COALESCE(temperature_count, 0) + excluded.temperature_count, 0),
+        last_weather_id = excluded.last_weather_id
+    ''')
+    return cursor.rowcount
+
+def discount_weather_rows(cursor, condition, params=()):
+    """Take the city_weather_data rows matching `condition` (on alias w) out of the running aggregates.
+
+    Called by timeseries.prune_observations just before it deletes them, so
+    city_avg_temperature and city_pollutant_summary keep averaging exactly the
+    retained rows. Rows past a watermark were never folded in and are skipped.
+    """
+    cursor.execute(f'''
+    UPDATE city_avg_temperature SET
+        temperature_sum = temperature_sum - d.total,
+        temperature_count = temperature_count - d.n,
+        avg_temperature = (temperature_sum - d.total) / NULLIF(temperature_count - d.n, 0)
+    FROM (SELECT a.city_id, TOTAL(w.temperature) AS total, COUNT(w.temperature) AS n
+          FROM city_avg_temperature a
+          JOIN city_weather_data w ON w.city_id = a.city_id AND w.id <= a.last_weather_id
+          WHERE {condition}
+          GROUP BY a.city_id) AS d
+    WHERE d.city_id = city_avg_temperature.city_id
+    ''', params)
+    for metric in WEATHER_METRICS:
+        cursor.execute(f'''
+        UPDATE city_pollutant_summary SET
+            value_sum = value_sum - d.total,
+            sample_count = sample_count - d.n,
+            avg_value = (value_sum - d.total) / NULLIF(sample_count - d.n, 0)
+        FROM (SELECT s.city_id, s.pollutant, TOTAL(w.{metric}) AS total, COUNT(w.{metric}) AS n
+              FROM city_pollutant_summary s
+              JOIN city_weather_data w ON w.city_id = s.city_id AND w.id <= s.last_weather_id
+              WHERE s.metric = '{metric}' AND {condition}
+              GROUP BY s.city_id, s.pollutant) AS d
+        WHERE d.city_id = city_pollutant_summary.city_id AND d.pollutant = city_pollutant_summary.pollutant
+          AND city_pollutant_summary.metric = '{metric}'
+        ''', params)
+
+def drop_unmatched_aggregates(cursor):
+    """Delete running aggregates of cities that no longer have a stored row with their dominant pollutant.
+
+    A full rebuild would not recreate them, so after a prune this keeps the
+    incremental tables equal to a rebuild.
+    """
+    cursor.execute('''
+    DELETE FROM city_avg_temperature
+    WHERE city_id NOT IN (SELECT city_id FROM city_aqi_data WHERE dominant_pollutant = 1)
+    ''')
     cursor.execute('''
-    SELECT DISTINCT city_id FROM city_aqi_data WHERE dominant_pollutant = 1
+    DELETE FROM city_pollutant_summary
+    WHERE NOT EXISTS (SELECT 1 FROM city_aqi_data a
+                      WHERE a.dominant_pollutant = city_pollutant_summary.pollutant
+                        AND a.city_id = city_pollutant_summary.city_id)
     ''')
-    city_ids_with_pollutant_1 = cursor.fetchall()
-
-    if not city_ids_with_pollutant_1:
-        print("No cities with pollutant 1 found.")
-        return
-    
-    for city_id_tuple in city_ids_with_pollutant_1:
-        city_id = city_id_tuple[0]
-        cursor.execute('''
-        SELECT AVG(temperature) FROM city_weather_data WHERE city_id = ?
-        ''', (city_id,))
-        
-        average_temperature = cursor.fetchone()[0]
-
-        if average_temperature is not None:
-            cursor.execute('''
-            SELECT name FROM cities WHERE id = ?
-            ''', (city_id,))
-            city_name = cursor.fetchone()[0]
-
-            print(f"Average temperature for {city_name} (with pollutant 1) is {average_temperature}°C.")
-            cursor.execute('''
-            INSERT OR REPLACE INTO city_avg_temperature (city_id, avg_temperature)
-            VALUES (?, ?)
-            ''', (city_id, average_temperature))
-        
+
+def verify_average_temperature(cursor, tolerance=1e-9):
+    """Return the city_ids whose stored average differs from a fresh AVG over the full history."""
+    cursor.execute('''
+    SELECT a.city_id
+    FROM city_avg_temperature a
+    JOIN (SELECT city_id, AVG(temperature) AS avg_temperature
+          FROM city_weather_data GROUP BY city_id) fresh ON fresh.city_id = a.city_id
+    WHERE a.avg_temperature IS NULL OR ABS(a.avg_temperature - fresh.avg_temperature) > ?
+    ''', (tolerance,))
+    return [row[0] for row in cursor.fetchall()]
+
+@instrumentation.timed()
+def calculate_and_store_average_temperature_for_pollutant_1(cursor, full_rebuild=False):
+    """Calculate and store the average temperature for cities with dominant pollutant = 1 (pm25).
+
+    Runs incrementally by default; full_rebuild=True first checks the running
+    aggregates against a full recomputation, then rebuilds them. The
+    city_pollutant_summary report is refreshed by refresh_pollutant_summary.
+    """
+    if full_rebuild:
+        mismatched = verify_average_temperature(cursor)
+        if mismatched:
+            logger.warning("Incremental averages differ from a full recomputation for city ids %s.", mismatched)
         else:
-            print(f"No temperature data found for city with ID {city_id}.")
+            logger.info("Incremental averages match a full recomputation.")
+    updated = update_average_temperature(cursor, full_rebuild)
+    if full_rebuild or updated:
+        logger.info("Updated average temperatures for %d cities with pollutant 1.", updated)
+
+@instrumentation.timed()
+def refresh_observation_summary(cursor, full_rebuild=False):
+    """Recompute city_observation_summary for cities that have batches newer than the summary.
+
+    AQI and weather rows are paired on (city_id, batch_id), so the work grows with
+    the number of observations, not their square. When nothing has been ingested
+    since the last refresh this is a single index lookup. full_rebuild=True
+    recomputes every city, e.g. after old observations were pruned.
+    """
+    if full_rebuild:
+        cursor.execute('DELETE FROM city_observation_summary')
+    cursor.execute('SELECT COALESCE(MAX(last_batch_id), 0) FROM city_observation_summary')
+    watermark = cursor.fetchone()[0]
+    numeric = "AVG(CASE WHEN typeof({0}) IN ('integer', 'real') THEN {0} END)"
+    cursor.execute(f'''
+    INSERT OR REPLACE INTO city_observation_summary (city_id, observation_count, avg_aqi, avg_forecasted_pm25,
+        avg_forecasted_pm10, avg_forecasted_o3, avg_humidity, avg_wind_speed, avg_temperature, last_batch_id)
+    SELECT a.city_id, COUNT(*), {numeric.format('a.aqi')}, {numeric.format('a.forecasted_pm25_avg')},
+        {numeric.format('a.forecasted_pm10_avg')}, {numeric.format('a.forecasted_o3_avg')},
+        {numeric.format('w.humidity')}, {numeric.format('w.wind_speed')}, {numeric.format('w.temperature')},
+        MAX(a.batch_id)
+    FROM city_aqi_data a
+    JOIN city_weather_data w ON w.city_id = a.city_id AND w.batch_id = a.batch_id
+    WHERE a.city_id IN (SELECT city_id FROM city_aqi_data WHERE batch_id > ?)
+    GROUP BY a.city_id
+    ''', (watermark,))
+    return cursor.rowcount
@@ -0,0 +1,94 @@
+import hashlib
+
+from parsers import CombinedRecord
+
+# Key of the in-memory index in db.PipelineConnection.lookup_cache
+_INDEX_KEY = 'latest_observation'
+
+
+def create_latest_observation_table(db_cursor):
+    """Create the table holding the content hashes of each city's latest stored AQI and weather observations."""
+    db_cursor.execute('''
+    CREATE TABLE IF NOT EXISTS city_latest_observation (
+        city_id INTEGER PRIMARY KEY,
+        aqi_hash INTEGER,
+        weather_hash INTEGER,
+        aqi_observed_at INTEGER,
+        weather_observed_at INTEGER,
+        batch_id INTEGER,
+        FOREIGN KEY(city_id) REFERENCES cities(id),
+        FOREIGN KEY(batch_id) REFERENCES ingest_batches(id)
+    )
+    ''')
+
+
+def _hash(values):
+    digest = hashlib.blake2b(repr(values).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def content_hashes(record):
+    """64-bit hashes of a CombinedRecord's AQI and weather values, each including its provider observation time.
+
+    The city id is left out. The results are signed so they fit an SQLite INTEGER.
+    """
+    return _hash(record.aqi[1:]), _hash(record.weather[1:])
+
+
+def load_index(db_cursor):
+    """Return {city_id: (aqi_hash, weather_hash)} of the latest stored observations.
+
+    The index is cached on db.PipelineConnection connections and dropped when
+    they roll back; on other connections it is loaded every call.
+    """
+    caches = getattr(db_cursor.connection, 'lookup_cache', None)
+    if caches is not None and _INDEX_KEY in caches:
+        return caches[_INDEX_KEY]
+    db_cursor.execute('SELECT city_id, aqi_hash, weather_hash FROM city_latest_observation')
+    index = {city_id: (aqi_hash, weather_hash) for city_id, aqi_hash, weather_hash in db_cursor.fetchall()}
+    if caches is not None:
+        caches[_INDEX_KEY] = index
+    return index
+
+
+def split_changed(db_cursor, records):
+    """Split CombinedRecords into (changed, unchanged) against the latest stored observations of each city.
+
+    The AQI and weather halves are compared separately: WAQI stations update
+    about hourly, OpenWeatherMap every few minutes. changed holds
+    (record to store, hashes) pairs, where the record to store has None in
+    place of an unchanged half, ready for remember once stored; unchanged
+    holds the records with neither half changed.
+    """
+    index = load_index(db_cursor)
+    changed = []
+    unchanged = []
+    for record in records:
+        hashes = content_hashes(record)
+        stored = index.get(record.aqi.city_id, (None, None))
+        if hashes == stored:
+            unchanged.append(record)
+            continue
+        changed.append((CombinedRecord(record.aqi if hashes[0] != stored[0] else None,
+                                       record.weather if hashes[1] != stored[1] else None), hashes))
+    return changed, unchanged
+
+
+def remember(db_cursor, hashed_records, batch_id):
+    """Record (stored record, hashes) pairs from split_changed as their cities' latest stored observations."""
+    rows = []
+    for record, (aqi_hash, weather_hash) in hashed_records:
+        half = record.aqi or record.weather
+        rows.append((half.city_id, aqi_hash, weather_hash, record.aqi and record.aqi.observed_at,
+                     record.weather and record.weather.observed_at, batch_id))
+    db_cursor.executemany('''
+    INSERT INTO city_latest_observation (city_id, aqi_hash, weather_hash, aqi_observed_at, weather_observed_at,
+        batch_id)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(city_id) DO UPDATE SET aqi_hash = excluded.aqi_hash, weather_hash = excluded.weather_hash,
+        aqi_observed_at = COALESCE(excluded.aqi_observed_at, aqi_observed_at),
+        weather_observed_at = COALESCE(excluded.weather_observed_at, weather_observed_at),
+        batch_id = excluded.batch_id
+    ''', rows)
+    index = load_index(db_cursor)
+    index.update((city_id, (aqi_hash, weather_hash)) for city_id, aqi_hash, weather_hash, _, _, _ in rows)
@@ -0,0 +1,184 @@
+import time
+import unicodedata
+
+from db import unit_of_work
+
+# Folded spelling -> canonical city name, for variants that Unicode folding alone
+# does not merge. The canonical name is what we send to the providers.
+CITY_ALIASES = {
+    'sao paulo': 'São Paulo',
+    'kyiv': 'Kiev',
+    'dusseldorf': 'Düsseldorf',
+    'bengaluru': 'Bangalore',
+    'new york city': 'New York',
+    'nyc': 'New York',
+    'peking': 'Beijing',
+}
+
+# A canonical city is fetched at most once per window (WAQI stations update about hourly)
+COLLECTION_WINDOW = 3600
+# Names a provider rejected are not retried for this long
+NEGATIVE_CACHE_SECONDS = 7 * 24 * 3600
+# A city whose fetch failed is retried after RETRY_BASE * 2**(failures - 1) seconds,
+# capped at one collection window
+RETRY_BASE = 60
+
+
+def fold_city_name(name):
+    """Fold a city name for matching: strip accents, casefold and collapse whitespace."""
+    decomposed = unicodedata.normalize('NFKD', name)
+    stripped = ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return ' '.join(stripped.casefold().split())
+
+
+def create_registry_tables(db_cursor):
+    """Create the alias, negative-cache and fetch-state tables of the city registry."""
+    db_cursor.execute('''
+    CREATE TABLE IF NOT EXISTS city_aliases (
+        alias_key TEXT PRIMARY KEY,
+        city_id INTEGER,
+        FOREIGN KEY(city_id) REFERENCES cities(id)
+    )
+    ''')
+    db_cursor.execute('''
+    CREATE TABLE IF NOT EXISTS invalid_cities (
+        alias_key TEXT PRIMARY KEY,
+        name TEXT,
+        reason TEXT,
+        failed_at INTEGER,
+        failures INTEGER
+    )
+    ''')
+    db_cursor.execute('''
+    CREATE TABLE IF NOT EXISTS city_fetch_state (
+        city_id INTEGER PRIMARY KEY,
+        status TEXT,
+        attempts INTEGER DEFAULT 0,
+        last_attempt_at INTEGER,
+        next_attempt_at INTEGER,
+        last_fetched_at INTEGER,
+        last_observed_at INTEGER,
+        last_error TEXT,
+        FOREIGN KEY(city_id) REFERENCES cities(id)
+    )
+    ''')
+
+
+def resolve_canonical_cities(db_cursor, city_requests):
+    """Map each requested name to its canonical (city_id, name), resolving new spellings once.
+
+    Returns {requested name: (city_id, canonical name)}. New folded spellings are
+    stored in city_aliases so later runs resolve them with a single lookup.
+    """
+    from file_functions import resolve_city_ids
+
+    db_cursor.execute('''
+    SELECT city_aliases.alias_key, cities.id, cities.name
+    FROM city_aliases JOIN cities ON cities.id = city_aliases.city_id
+    ''')
+    known = {alias_key: (city_id, name) for alias_key, city_id, name in db_cursor.fetchall()}
+
+    unresolved = {}
+    for name in city_requests:
+        key = fold_city_name(name)
+        if key not in known:
+            unresolved.setdefault(key, CITY_ALIASES.get(key, name.strip()))
+    if unresolved:
+        # Committed on their own, so the write transaction does not stay open while the batch is fetched
+        with unit_of_work(db_cursor.connection):
+            # Prefer a city row whose folded name already matches, so old duplicates collapse onto it
+            db_cursor.execute('SELECT id, name FROM cities ORDER BY id')
+            existing = {}
+            for city_id, name in db_cursor.fetchall():
+                existing.setdefault(fold_city_name(name), (city_id, name))
+            missing = [name for key, name in unresolved.items() if fold_city_name(name) not in existing]
+            new_ids = resolve_city_ids(db_cursor, missing)
+            for key, name in unresolved.items():
+                if name in new_ids:
+                    known[key] = (new_ids[name], name)
+                else:
+                    known[key] = existing[fold_city_name(name)]
+            db_cursor.executemany('''
+            INSERT OR REPLACE INTO city_aliases (alias_key, city_id) VALUES (?, ?)
+            ''', [(key, known[key][0]) for key in unresolved])
+    return {name: known[fold_city_name(name)] for name in city_requests}
+
+
+def build_city_work_queue(db_cursor, city_requests, window_seconds=COLLECTION_WINDOW, now=None):
+    """Return the canonical (city_id, name) pairs due for fetching.
+
+    Each canonical city appears once. Cities fetched successfully within the
+    window, failed cities still backing off and names in the negative cache are
+    left out. Failed cities that are due again come first, then the rest with
+    the stalest (or never fetched) first, so a restarted run retries exactly what
+    did not make it.
+    """
+    now = int(time.time()) if now is None else now
+    db_cursor.execute('SELECT alias_key FROM invalid_cities WHERE failed_at > ?', (now - NEGATIVE_CACHE_SECONDS,))
+    invalid = {row[0] for row in db_cursor.fetchall()}
+
+    db_cursor.execute('''
+    SELECT city_id FROM city_fetch_state WHERE last_fetched_at > ? OR next_attempt_at > ?
+    ''', (now - window_seconds, now))
+    not_due = {row[0] for row in db_cursor.fetchall()}
+    db_cursor.execute("SELECT city_id, status = 'failed', COALESCE(last_fetched_at, 0) FROM city_fetch_state")
+    priority = {city_id: (not failed, last_fetched_at) for city_id, failed, last_fetched_at in db_cursor.fetchall()}
+
+    queue = []
+    seen = set()
+    for city_id, name in resolve_canonical_cities(db_cursor, city_requests).values():
+        if city_id not in seen and city_id not in not_due and fold_city_name(name) not in invalid:
+            seen.add(city_id)
+            queue.append((city_id, name))
+    queue.sort(key=lambda item: priority.get(item[0], (True, 0)))
+    return queue
+
+
+def next_due_time(db_cursor, window_seconds=COLLECTION_WINDOW):
+    """Epoch time at which the next already-fetched city becomes due again, or None."""
+    db_cursor.execute('''
+    SELECT MIN(CASE WHEN status = 'failed' THEN next_attempt_at ELSE last_fetched_at + ? END)
+    FROM city_fetch_state
+    ''', (window_seconds,))
+    return db_cursor.fetchone()[0]
+
+
+def record_fetch_results(db_cursor, succeeded, failed, window_seconds=COLLECTION_WINDOW, now=None):
+    """Checkpoint the outcome of a batch in city_fetch_state.
+
+    succeeded maps city_id to the newest observed_at stored for it, failed maps
+    city_id to an error message. Nothing is committed here: callers run this in
+    the same transaction as the rows it describes, so data and checkpoint are
+    either both stored or both lost.
+    """
+    now = int(time.time()) if now is None else now
+    db_cursor.executemany('''
+    INSERT INTO city_fetch_state (city_id, status, attempts, last_attempt_at, next_attempt_at,
+        last_fetched_at, last_observed_at, last_error)
+    VALUES (?, 'ok', 0, ?, NULL, ?, ?, NULL)
+    ON CONFLICT(city_id) DO UPDATE SET status = 'ok', attempts = 0, last_attempt_at = excluded.last_attempt_at,
+        next_attempt_at = NULL, last_fetched_at = excluded.last_fetched_at,
+        last_observed_at = MAX(COALESCE(last_observed_at, 0), excluded.last_observed_at), last_error = NULL
+    ''', [(city_id, now, now, observed_at) for city_id, observed_at in succeeded.items()])
+    db_cursor.executemany('''
+    INSERT INTO city_fetch_state (city_id, status, attempts, last_attempt_at, next_attempt_at, last_error)
+    VALUES (:city_id, 'failed', 1, :now, :now + :base, :error)
+    ON CONFLICT(city_id) DO UPDATE SET status = 'failed', attempts = attempts + 1, last_attempt_at = :now,
+        next_attempt_at = :now + MIN(:window, :base * (1 << attempts)), last_error = :error
+    ''', [{'city_id': city_id, 'now': now, 'base': RETRY_BASE, 'window': window_seconds, 'error': error}
+          for city_id, error in failed.items()])
+
+
+def is_unknown_city_response(aqi_data):
+    """True when WAQI answered that it has no station for the requested name."""
+    return bool(aqi_data) and aqi_data.get('status') == 'error' and 'unknown station' in str(aqi_data.get('data')).lower()
+
+
+def mark_invalid(db_cursor, name, reason, now=None):
+    """Put a city name in the negative cache so it is not requested again for a while."""
+    now = int(time.time()) if now is None else now
+    db_cursor.execute('''
+    INSERT INTO invalid_cities (alias_key, name, reason, failed_at, failures) VALUES (?, ?, ?, ?, 1)
+    ON CONFLICT(alias_key) DO UPDATE SET reason = excluded.reason, failed_at = excluded.failed_at,
+        failures = failures + 1
+    ''', (fold_city_name(name), name, reason, now))
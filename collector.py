@@ -0,0 +1,103 @@
+import logging
+import signal
+import threading
+import time
+
+import file_functions
+import response_cache
+import timeseries
+import structured_logging
+from calculations import refresh_observation_summary
+from city_registry import COLLECTION_WINDOW, next_due_time
+from db import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+# Default request budgets (requests per second, burst size) matching the free
+# tiers: WAQI allows 1000 requests/minute, OpenWeatherMap 60 calls/minute.
+PROVIDER_QUOTAS = {
+    'waqi': (1000 / 60, 50),
+    'openweathermap': (60 / 60, 60),
+}
+# Longest the collector sleeps before re-checking for due cities
+MAX_IDLE_SECONDS = 60
+
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is free or the stop event is set."""
+
+    def __init__(self, rate, capacity, stop_event=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.stop_event = stop_event or threading.Event()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Take one token, waiting as needed. Returns False if the stop event was set first."""
+        while not self.stop_event.is_set():
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            self.stop_event.wait(wait)
+        return False
+
+
+def install_rate_limiters(stop_event, quotas=PROVIDER_QUOTAS):
+    """Register one TokenBucket per provider with file_functions' rate-limit hook."""
+    for provider, (rate, burst) in quotas.items():
+        file_functions.RATE_LIMITERS[provider] = TokenBucket(rate, burst, stop_event)
+
+
+def install_signal_handlers(stop_event):
+    """Make SIGTERM and SIGINT request a graceful stop after the current batch."""
+    def request_stop(signum, frame):
+        logger.warning("Received signal %d, stopping after the current batch...", signum)
+        stop_event.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+
+def run_collector(db_cursor, city_requests, cadence=COLLECTION_WINDOW, batch_size=25,
+                  quotas=PROVIDER_QUOTAS, batched=False, stop_event=None):
+    """Poll every city once per `cadence` seconds until stopped.
+
+    Each iteration ingests the stalest due cities through
+    get_multiple_city_combined_data, with requests paced by per-provider token
+    buckets, then refreshes the time-series rollups and the per-city summary.
+    When nothing is due the collector sleeps until the next city is. Cached
+    responses expire after at most `cadence` seconds, so every poll reaches the
+    providers. Returns the number of cities ingested.
+    """
+    stop_event = stop_event or threading.Event()
+    response_cache.MAX_TTL = cadence
+    install_rate_limiters(stop_event, quotas)
+    processed = 0
+    try:
+        while not stop_event.is_set():
+            fetched, remaining = file_functions.get_multiple_city_combined_data(
+                city_requests, db_cursor, batch_size=batch_size, window_seconds=cadence, batched=batched)
+            processed += fetched
+            if fetched:
+                with unit_of_work(db_cursor.connection):
+                    timeseries.refresh_rollups(db_cursor)
+                    refresh_observation_summary(db_cursor)
+            structured_logging.flush_logs()
+            if remaining:
+                continue
+            due = next_due_time(db_cursor, cadence)
+            idle = MAX_IDLE_SECONDS if due is None else due - time.time()
+            stop_event.wait(min(max(idle, 1), MAX_IDLE_SECONDS))
+    finally:
+        file_functions.RATE_LIMITERS.clear()
+    logger.info("Collector stopped after ingesting %d cities.", processed)
+    return processed
@@ -0,0 +1,222 @@
+import json
+import os
+import shutil
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    from pyarrow import fs
+except ImportError:  # pyarrow is optional; callers fall back to SQLite
+    pa = None
+    pc = None
+    ds = None
+    pq = None
+    fs = None
+
+SNAPSHOT_DIR = 'columnar'
+MANIFEST_NAME = '_snapshot.json'
+# Bumped when TABLE_SCHEMAS or the layout changes; snapshots in an older format are re-exported from scratch
+SNAPSHOT_FORMAT = 3
+
+# Typed Arrow schemas of the exported tables; every table also has city_id, and date is the partition key
+TABLE_SCHEMAS = {
+    'city_aqi_data': [
+        ('id', 'int64'), ('batch_id', 'int64'), ('observed_at', 'int64'), ('aqi', 'float64'),
+        ('dominant_pollutant', 'int64'), ('forecasted_pm25_avg', 'float64'), ('forecasted_pm10_avg', 'float64'),
+        ('forecasted_o3_avg', 'float64'),
+    ],
+    'city_weather_data': [
+        ('id', 'int64'), ('batch_id', 'int64'), ('observed_at', 'int64'), ('temperature', 'float64'),
+        ('weather_description', 'int64'), ('humidity', 'float64'), ('wind_speed', 'float64'),
+    ],
+}
+
+
+def available():
+    """True when pyarrow is installed and snapshots can be written and read."""
+    return pa is not None
+
+
+def _partitioning():
+    return ds.partitioning(pa.schema([('date', pa.string())]), flavor='hive')
+
+
+def _file_schema(table):
+    fields = [(name, getattr(pa, type_name)()) for name, type_name in TABLE_SCHEMAS[table]]
+    return pa.schema(fields + [('city_id', pa.int64())])
+
+
+def _arrow_schema(table):
+    return _file_schema(table).append(pa.field('date', pa.string()))
+
+
+def _dataset(table, snapshot_dir, **kwargs):
+    return ds.dataset(os.path.abspath(os.path.join(snapshot_dir, table)), schema=_arrow_schema(table),
+                      format='parquet', partitioning=_partitioning(), **kwargs)
+
+
+def _parquet_files(partition_path):
+    return sorted(os.path.join(partition_path, name) for name in os.listdir(partition_path)
+                  if name.endswith('.parquet'))
+
+
+def _rewrite_partition(partition_path, rows, name):
+    """Replace every part file of a date partition with one file of `rows`, sorted by city_id and id."""
+    files = _parquet_files(partition_path) if os.path.isdir(partition_path) else []
+    os.makedirs(partition_path, exist_ok=True)
+    path = os.path.join(partition_path, name)
+    pq.write_table(rows.sort_by([('city_id', 'ascending'), ('id', 'ascending')]), path + '.tmp')
+    for old in files:
+        os.remove(old)
+    os.replace(path + '.tmp', path)
+
+
+def read_manifest(snapshot_dir=SNAPSHOT_DIR):
+    """Return {table: last exported id}, empty if nothing (or an older format) has been exported."""
+    path = os.path.join(snapshot_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.pop('format', 1) != SNAPSHOT_FORMAT:
+        return {}
+    return manifest
+
+
+def _write_manifest(manifest, snapshot_dir):
+    path = os.path.join(snapshot_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(dict(manifest, format=SNAPSHOT_FORMAT), f)
+    os.replace(path + '.tmp', path)
+
+
+def export_snapshot(db_cursor, snapshot_dir=SNAPSHOT_DIR):
+    """Add rows added since the last export to Parquet files partitioned by date.
+
+    Each date partition holds a single file sorted by city_id (so city
+    filters can skip row groups): a partition that gets new rows is compacted
+    with them into a new file, instead of collecting one small file per
+    export. Returns the number of rows exported per table.
+    """
+    manifest = read_manifest(snapshot_dir)
+    exported = {}
+    for table, columns in TABLE_SCHEMAS.items():
+        root = os.path.join(snapshot_dir, table)
+        last_id = manifest.get(table, 0)
+        if not last_id:
+            # Start over, so part files of an older format never mix with new ones
+            shutil.rmtree(root, ignore_errors=True)
+        names = ', '.join(name for name, _ in columns)
+        df = pd.read_sql_query(f'''
+        SELECT {names}, city_id, date(observed_at, 'unixepoch') AS date
+        FROM {table} WHERE id > ? ORDER BY id
+        ''', db_cursor.connection, params=(last_id,))
+        exported[table] = len(df)
+        if df.empty:
+            continue
+        # WAQI reports missing readings as '-'; coerce once here instead of in every reader
+        for name, _ in columns:
+            df[name] = pd.to_numeric(df[name], errors='coerce')
+        max_id = int(df['id'].max())
+        for day, rows in df.groupby('date'):
+            partition_path = os.path.join(root, f'date={day}')
+            new_rows = pa.Table.from_pandas(rows.drop(columns='date'), schema=_file_schema(table),
+                                            preserve_index=False)
+            existing = [pq.read_table(path, schema=_file_schema(table)) for path in _parquet_files(partition_path)] \
+                if os.path.isdir(partition_path) else []
+            _rewrite_partition(partition_path, pa.concat_tables(existing + [new_rows]), f'part-{max_id}.parquet')
+        manifest[table] = max_id
+    os.makedirs(snapshot_dir, exist_ok=True)
+    _write_manifest(manifest, snapshot_dir)
+    return exported
+
+
+def prune_snapshot(db_cursor, cutoff, snapshot_dir=SNAPSHOT_DIR):
+    """Remove snapshot rows that timeseries.prune_observations deleted from SQLite.
+
+    Only date partitions up to the cutoff's day can hold pruned rows. A
+    partition without surviving rows is deleted outright; one with some
+    survivors (rows kept because the other half of their batch is newer) is
+    rewritten with just those. Returns the number of partitions touched.
+    """
+    cutoff_day = datetime.fromtimestamp(cutoff, tz=timezone.utc).strftime('%Y-%m-%d')
+    touched = 0
+    for table in TABLE_SCHEMAS:
+        root = os.path.join(snapshot_dir, table)
+        if not os.path.isdir(root):
+            continue
+        db_cursor.execute(f'''
+        SELECT date(observed_at, 'unixepoch'), id FROM {table} WHERE date(observed_at, 'unixepoch') <= ?
+        ''', (cutoff_day,))
+        survivors = defaultdict(set)
+        for day, row_id in db_cursor.fetchall():
+            survivors[day].add(row_id)
+        for date_dir in os.listdir(root):
+            day = _partition_value(date_dir)
+            if day > cutoff_day:
+                continue
+            touched += 1
+            partition_path = os.path.join(root, date_dir)
+            keep = survivors.get(day)
+            if not keep:
+                shutil.rmtree(partition_path)
+                continue
+            rows = pa.concat_tables([pq.read_table(path, schema=_file_schema(table))
+                                     for path in _parquet_files(partition_path)])
+            kept = rows.filter(pc.is_in(rows['id'], value_set=pa.array(sorted(keep), pa.int64())))
+            if kept.num_rows != rows.num_rows:
+                _rewrite_partition(partition_path, kept, f'part-pruned-{cutoff}.parquet')
+    return touched
+
+
+def _partition_value(name):
+    return name.split('=', 1)[1]
+
+
+def _snapshot_row_count(table, snapshot_dir):
+    if not os.path.isdir(os.path.join(snapshot_dir, table)):
+        return 0
+    return _dataset(table, snapshot_dir).count_rows()
+
+
+def snapshot_is_current(db_cursor, snapshot_dir=SNAPSHOT_DIR):
+    """True when every exported table has the database's newest row and the same number of rows.
+
+    The row count catches rows pruned from SQLite but still in the snapshot.
+    Ids are never reused
+    (the tables are AUTOINCREMENT), so a pruned newest row leaves the manifest
+    ahead of MAX(id) without making the snapshot stale.
+    """
+    manifest = read_manifest(snapshot_dir)
+    for table in TABLE_SCHEMAS:
+        db_cursor.execute(f'SELECT COALESCE(MAX(id), 0), COUNT(*) FROM {table}')
+        newest_id, row_count = db_cursor.fetchone()
+        if newest_id > manifest.get(table, 0) or row_count != _snapshot_row_count(table, snapshot_dir):
+            return False
+    return True
+
+
+def load_table(table, columns=None, snapshot_dir=SNAPSHOT_DIR, city_ids=None):
+    """Memory-map an exported table into a typed DataFrame, optionally for a subset of cities."""
+    path = os.path.join(snapshot_dir, table)
+    if not os.path.isdir(path):
+        return pd.DataFrame({name: pd.Series(dtype=type_name) for name, type_name in TABLE_SCHEMAS[table] + [('city_id', 'int64')]
+                             if columns is None or name in columns})
+    dataset = _dataset(table, snapshot_dir, filesystem=fs.LocalFileSystem(use_mmap=True))
+    filter_expression = ds.field('city_id').isin(list(city_ids)) if city_ids is not None else None
+    return dataset.to_table(columns=columns, filter=filter_expression).to_pandas()
+
+
+def load_aqi_weather_frame(snapshot_dir=SNAPSHOT_DIR):
+    """Build the same frame as visualizations.fetch_aqi_data from the snapshot."""
+    aqi = load_table('city_aqi_data', ['city_id', 'batch_id', 'aqi', 'forecasted_pm25_avg', 'forecasted_pm10_avg',
+                                       'forecasted_o3_avg'], snapshot_dir)
+    weather = load_table('city_weather_data', ['city_id', 'batch_id', 'humidity', 'wind_speed', 'temperature'],
+                         snapshot_dir)
+    return aqi.merge(weather, on=['city_id', 'batch_id']).drop(columns='batch_id')
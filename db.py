@@ -0,0 +1,163 @@
+import contextlib
+import os
+import queue
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+import instrumentation
+
+DB_PATH = 'global_combined_data.db'
+
+# Pragma profile applied to every connection. journal_mode=WAL is persistent in the
+# database file; the others are per-connection settings.
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # negative means KiB, so 64 MiB
+    'temp_store': 'MEMORY',
+}
+# Compiled statements kept per connection, keyed by SQL text (sqlite3's default is 128)
+CACHED_STATEMENTS = 512
+# Read-only connections kept open per database for analytics and plotting readers
+READ_POOL_SIZE = 4
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PipelineConnection(sqlite3.Connection):
+    """sqlite3 connection that tracks unit_of_work nesting and caches lookup tables.
+
+    lookup_cache holds dictionary_encoding maps; it is dropped on rollback so
+    ids registered in a rolled-back transaction are never reused.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.unit_depth = 0
+        self.lookup_cache = {}
+
+    def rollback(self):
+        self.lookup_cache.clear()
+        super().rollback()
+
+
+def apply_pragmas(connection, pragmas=PRAGMAS):
+    """Apply the tuned pragma profile to an open connection."""
+    for name, value in pragmas.items():
+        connection.execute(f'PRAGMA {name} = {value}')
+
+
+def connect_db(db_path=DB_PATH, read_only=False):
+    """Open the combined database with the tuned pragma profile applied.
+
+    Statements are compiled once per connection and reused from its statement
+    cache. read_only=True opens the file with a mode=ro URI, for readers that
+    must never take the write lock.
+    """
+    if read_only:
+        uri = f'file:{pathname2url(os.path.abspath(db_path))}?mode=ro'
+        connection = sqlite3.connect(uri, uri=True, factory=PipelineConnection, cached_statements=CACHED_STATEMENTS,
+                                     check_same_thread=False)
+        pragmas = {name: value for name, value in PRAGMAS.items() if name != 'journal_mode'}
+    else:
+        connection = sqlite3.connect(db_path, factory=PipelineConnection, cached_statements=CACHED_STATEMENTS)
+        pragmas = PRAGMAS
+    if instrumentation.is_enabled():
+        instrumentation.trace_connection(connection)
+    apply_pragmas(connection, pragmas)
+    return connection
+
+
+@contextlib.contextmanager
+def unit_of_work(connection):
+    """Run the block as one transaction: commit when it succeeds, roll back when it raises.
+
+    Nested units join the outermost one, so a helper can wrap its own writes
+    and still be called from inside a larger batch; only the outermost unit
+    commits. Plain sqlite3 connections cannot track nesting, so on those a unit
+    opened inside an existing transaction joins it.
+    """
+    if hasattr(connection, 'unit_depth'):
+        depth = connection.unit_depth
+    else:
+        depth = 1 if connection.in_transaction else 0
+    if depth == 0 and not connection.in_transaction:
+        connection.execute('BEGIN')
+    if hasattr(connection, 'unit_depth'):
+        connection.unit_depth = depth + 1
+    try:
+        yield connection
+    except BaseException:
+        if depth == 0:
+            connection.rollback()
+        raise
+    else:
+        if depth == 0:
+            connection.commit()
+    finally:
+        if hasattr(connection, 'unit_depth'):
+            connection.unit_depth = depth
+
+
+class ReadOnlyPool:
+    """A small pool of read-only connections to one database.
+
+    In WAL mode readers see the last committed state and never block the
+    writer. Connections are opened lazily, up to `size`, and reused.
+    """
+
+    def __init__(self, db_path=DB_PATH, size=READ_POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a read-only connection for the duration of the block."""
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            connection = connect_db(self.db_path, read_only=True) if can_open else self._idle.get()
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()
+            self._idle.put(connection)
+
+    def close(self):
+        """Close every idle connection."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._opened = 0
+
+
+def read_pool(db_path=DB_PATH):
+    """Return the shared ReadOnlyPool for a database, creating it on first use."""
+    key = os.path.abspath(db_path)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ReadOnlyPool(db_path)
+        return _pools[key]
+
+
+def close_pools():
+    """Close the connections of every shared read-only pool."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
@@ -0,0 +1,65 @@
+# Bound parameters per SELECT when reading back newly registered ids
+MAX_PARAMETERS = 500
+
+
+class Dictionary:
+    """A (value -> id) lookup table used to store provider strings as small integer ids.
+
+    The table is loaded once per connection into an in-process cache, and
+    values the cache has not seen are registered in bulk, so the insert path
+    never looks up one value at a time.
+    """
+
+    def __init__(self, table, key_column):
+        self.table = table
+        self.key_column = key_column
+
+    def warm(self, db_cursor):
+        """Return the cached {value: id} map, loading the whole table on first use.
+
+        The map is cached on db.PipelineConnection connections (and dropped
+        when they roll back); on other connections it is loaded every call.
+        """
+        caches = getattr(db_cursor.connection, 'lookup_cache', None)
+        if caches is not None and self.table in caches:
+            return caches[self.table]
+        db_cursor.execute(f'SELECT {self.key_column}, id FROM {self.table}')
+        ids = dict(db_cursor.fetchall())
+        if caches is not None:
+            caches[self.table] = ids
+        return ids
+
+    def encode(self, db_cursor, values):
+        """Return a {value: id} map covering every non-None value, registering unseen ones.
+
+        Unseen values are inserted with one executemany and their ids read back
+        with one SELECT per MAX_PARAMETERS values. New ids are written in the caller's transaction.
+        """
+        ids = self.warm(db_cursor)
+        unseen = sorted({value for value in values if value is not None and value not in ids})
+        if unseen:
+            db_cursor.executemany(f'INSERT OR IGNORE INTO {self.table} ({self.key_column}) VALUES (?)',
+                                  [(value,) for value in unseen])
+            for start in range(0, len(unseen), MAX_PARAMETERS):
+                chunk = unseen[start:start + MAX_PARAMETERS]
+                db_cursor.execute(f'SELECT {self.key_column}, id FROM {self.table} '
+                                  f'WHERE {self.key_column} IN ({", ".join("?" * len(chunk))})', chunk)
+                ids.update(db_cursor.fetchall())
+        return ids
+
+    def decode(self, db_cursor):
+        """Return the reverse {id: value} map."""
+        return {value_id: value for value, value_id in self.warm(db_cursor).items()}
+
+
+# WAQI dominant pollutant names (pm25, pm10, o3, no2, ...)
+POLLUTANTS = Dictionary('pollutants', 'name')
+# OpenWeatherMap condition descriptions (clear sky, light rain, ...)
+WEATHER_CONDITIONS = Dictionary('weather_conditions', 'description')
+DICTIONARIES = (POLLUTANTS, WEATHER_CONDITIONS)
+
+
+def warm_dictionaries(db_cursor):
+    """Load every lookup table into the connection's cache, once per run."""
+    for dictionary in DICTIONARIES:
+        dictionary.warm(db_cursor)
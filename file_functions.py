@@ -1,12 +1,39 @@
+import logging
 import requests
 import sqlite3
-import os
+import http_client
+import response_cache
+import provider_batch
+import api_config
+import instrumentation
+import streaming
+import change_detection
+from db import unit_of_work
+from dictionary_encoding import POLLUTANTS, WEATHER_CONDITIONS
+from parsers import CombinedRecord, loads, parse_owm_weather, parse_waqi_feed
+from calculations import update_average_temperature
+from timeseries import create_rollup_tables
+from city_registry import (COLLECTION_WINDOW, build_city_work_queue, create_registry_tables, is_unknown_city_response,
+                           mark_invalid, record_fetch_results)
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on simultaneous in-flight requests per provider
+PROVIDER_CONCURRENCY = {'waqi': 8, 'openweathermap': 8}
+# Optional per-provider rate limiters (anything with acquire() -> bool, see collector.TokenBucket)
+RATE_LIMITERS = {}
+
+# Raised when a rate limiter gives up because the collector is stopping
+class FetchInterrupted(Exception):
+    """The request was never sent: a rate limiter's acquire() returned False."""
 
 # Fetch AQI data using the aqicn API
 def get_aqi_data(city):
     """Get AQI data for a city."""
-    api_url = f'https://api.waqi.info/feed/{city}/?token=2f4c73a57b156c067a7fb45fa17784bd26cd0a8f'
-    return get_api_data(api_url)
+    return get_cached_api_data('waqi', city, api_config.waqi_feed_url(city))
 
 # Fetch weather data using the openweathermap API
 def get_weather_data_for_city(city):
@@ -14,17 +41,39 @@ def get_weather_data_for_city(city):
     from accuWeather import get_city_weather
     return get_city_weather(city)
 
-# General API data fetch function
+# General API data fetch function (pooled keep-alive session with timeouts and retries)
+@instrumentation.timed()
 def get_api_data(api_url):
-    response = requests.get(api_url)
+    try:
+        response = http_client.get(api_url)
+    except requests.RequestException as e:
+        logger.warning("Request failed: %s", e)
+        return None
     if response.status_code == 200:
-        data = response.json()
-        return data
+        try:
+            return loads(response.content)
+        except ValueError as e:
+            logger.warning("Invalid JSON from %s: %s", response.url, e)
+            return None
     else:
-        print(f"Error: {response.status_code} - {response.text}")
+        logger.warning("HTTP %s from %s: %s", response.status_code, response.url, response.text[:200])
         return None
 
-# Create all tables without the timestamp column
+# Fetch through the on-disk response cache, only storing successful payloads
+def get_cached_api_data(provider, city, api_url):
+    """Return the cached payload for (provider, city), fetching and caching it on a miss."""
+    data = response_cache.get(provider, city)
+    if data is not None:
+        return data
+    limiter = RATE_LIMITERS.get(provider)
+    if limiter is not None and not limiter.acquire():
+        raise FetchInterrupted(provider)  # shutting down; the city stays due
+    data = get_api_data(api_url)
+    if data and (data.get('status') == 'ok' or data.get('cod') == 200):
+        response_cache.put(provider, city, data)
+    return data
+
+# Create all tables; observations carry the provider's epoch timestamp in observed_at
 def create_combined_tables(db_cursor):
     """Create the pollutants, weather_conditions, cities, city_aqi_data, and city_weather_data tables."""
     db_cursor.execute('''
@@ -64,17 +113,30 @@ def create_combined_tables(db_cursor):
     )
     ''')
 
+    # One row per ingest batch; an AQI and a weather row with the same (city_id, batch_id)
+    # are the same observation
+    db_cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ingest_batches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started_at INTEGER,
+        city_count INTEGER
+    )
+    ''')
+
     db_cursor.execute('''
     CREATE TABLE IF NOT EXISTS city_aqi_data (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         city_id INTEGER,
+        observed_at INTEGER,
         aqi INTEGER,
         dominant_pollutant INTEGER,
         forecasted_pm25_avg REAL,
         forecasted_pm10_avg REAL,
         forecasted_o3_avg REAL,
+        batch_id INTEGER,
         FOREIGN KEY(city_id) REFERENCES cities(id),
-        FOREIGN KEY(dominant_pollutant) REFERENCES pollutants(id)
+        FOREIGN KEY(dominant_pollutant) REFERENCES pollutants(id),
+        FOREIGN KEY(batch_id) REFERENCES ingest_batches(id)
     )
     ''')
 
@@ -82,153 +144,332 @@ def create_combined_tables(db_cursor):
     CREATE TABLE IF NOT EXISTS city_weather_data (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         city_id INTEGER,
+        observed_at INTEGER,
         temperature REAL,
         weather_description INTEGER,
         humidity INTEGER,
         wind_speed REAL,
+        batch_id INTEGER,
         FOREIGN KEY(city_id) REFERENCES cities(id),
-        FOREIGN KEY(weather_description) REFERENCES weather_conditions(id)
+        FOREIGN KEY(weather_description) REFERENCES weather_conditions(id),
+        FOREIGN KEY(batch_id) REFERENCES ingest_batches(id)
     )
     ''')
 
-    db_cursor.connection.commit()
-
-# Insert combined AQI and weather data into the database
-def insert_combined_data(db_cursor, combined_data):
-    """Insert combined AQI and weather data into the database."""
-    
-    for data in combined_data:
-        city_data = data['city_data']
-        weather_data = data['weather_data']
-        
-        dominant_pollutant_name = city_data['dominant_pollutant']
-        db_cursor.execute('''
-        SELECT id FROM pollutants WHERE name = ?
-        ''', (dominant_pollutant_name,))
-        dominant_pollutant_id = db_cursor.fetchone()
-        
-        if dominant_pollutant_id:
-            dominant_pollutant_id = dominant_pollutant_id[0]
-        else:
-            dominant_pollutant_id = None 
-        
-        db_cursor.execute('''
-        INSERT INTO city_aqi_data (city_id, aqi, dominant_pollutant, forecasted_pm25_avg, 
-            forecasted_pm10_avg, forecasted_o3_avg)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            city_data['city_id'], city_data['aqi'], dominant_pollutant_id,
-            city_data['forecasted_pm25_avg'], city_data['forecasted_pm10_avg'], city_data['forecasted_o3_avg']
-        ))
-        
-        weather_description = weather_data['weather_description']
-        db_cursor.execute('''
-        SELECT id FROM weather_conditions WHERE description = ?
-        ''', (weather_description,))
-        weather_description_id = db_cursor.fetchone()
+    create_indexes(db_cursor)
+    create_rollup_tables(db_cursor)
+    create_registry_tables(db_cursor)
+    change_detection.create_latest_observation_table(db_cursor)
+    provider_batch.create_provider_id_table(db_cursor)
+
+def create_indexes(db_cursor):
+    """Create the indexes used by the per-city aggregation and the AQI/weather join."""
+    db_cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_city_aqi_data_city_time ON city_aqi_data (city_id, observed_at)
+    ''')
+    db_cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_city_aqi_data_pollutant_city ON city_aqi_data (dominant_pollutant, city_id)
+    ''')
+    # Covers AVG(temperature) ... WHERE city_id = ? without touching the table
+    db_cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_city_weather_data_city ON city_weather_data (city_id, temperature)
+    ''')
+    db_cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_city_weather_data_city_time ON city_weather_data (city_id, observed_at)
+    ''')
+    # Pair AQI and weather rows of the same observation, and find cities with new batches
+    db_cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_city_aqi_data_batch ON city_aqi_data (batch_id)
+    ''')
+    db_cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_city_weather_data_city_batch ON city_weather_data (city_id, batch_id)
+    ''')
 
-        if weather_description_id:
-            weather_description_id = weather_description_id[0]
-        else:
-            weather_description_id = None 
+# Register a new ingest batch and return its id
+def start_ingest_batch(db_cursor, city_count=None):
+    """Insert an ingest_batches row and return its id."""
+    db_cursor.execute('INSERT INTO ingest_batches (started_at, city_count) VALUES (?, ?)',
+                      (int(time.time()), city_count))
+    return db_cursor.lastrowid
 
-        db_cursor.execute('''
-        INSERT INTO city_weather_data (city_id, temperature, weather_description, humidity, wind_speed)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (
-            weather_data['city_id'], weather_data['temperature'],
-            weather_description_id, weather_data['humidity'], weather_data['wind_speed']
-        ))
+# Insert combined AQI and weather data into the database; both rows of a record share a batch_id,
+# which is how readers pair them, so each city may appear at most once per batch
+@instrumentation.timed()
+def insert_combined_data(db_cursor, combined_data, batch_id=None):
+    """Insert CombinedRecords (either half may be None) in one unit of work and return the batch id."""
+    combined_data = list(combined_data)
+    with unit_of_work(db_cursor.connection):
+        return _insert_combined_rows(db_cursor, combined_data, batch_id)
 
-    db_cursor.connection.commit()
+def _insert_combined_rows(db_cursor, combined_data, batch_id):
+    if batch_id is None:
+        batch_id = start_ingest_batch(db_cursor, len(combined_data))
+    aqi_records = [aqi for aqi, _ in combined_data if aqi is not None]
+    weather_records = [weather for _, weather in combined_data if weather is not None]
+    pollutant_ids = POLLUTANTS.encode(db_cursor, [aqi.dominant_pollutant for aqi in aqi_records])
+    condition_ids = WEATHER_CONDITIONS.encode(db_cursor, [weather.weather_description for weather in weather_records])
 
-# Fetch both AQI and weather data for a single city
-def get_combined_city_data(city, db_cursor):
-    db_cursor.execute('''
+    aqi_rows = [(
+        aqi.city_id, aqi.observed_at, aqi.aqi, pollutant_ids.get(aqi.dominant_pollutant),
+        aqi.forecasted_pm25_avg, aqi.forecasted_pm10_avg, aqi.forecasted_o3_avg, batch_id
+    ) for aqi in aqi_records]
+    weather_rows = [(
+        weather.city_id, weather.observed_at, weather.temperature,
+        condition_ids.get(weather.weather_description), weather.humidity, weather.wind_speed, batch_id
+    ) for weather in weather_records]
+
+    db_cursor.executemany('''
+    INSERT INTO city_aqi_data (city_id, observed_at, aqi, dominant_pollutant, forecasted_pm25_avg, 
+        forecasted_pm10_avg, forecasted_o3_avg, batch_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', aqi_rows)
+    db_cursor.executemany('''
+    INSERT INTO city_weather_data (city_id, observed_at, temperature, weather_description, humidity, wind_speed,
+        batch_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', weather_rows)
+    return batch_id
+
+# Look up (or create) the id of a city in the cities table
+def get_city_id(city, db_cursor):
+    """Return the cities.id for a city name, inserting the city if needed."""
+    return resolve_city_ids(db_cursor, [city])[city]
+
+# Resolve many city names to ids at once
+def resolve_city_ids(db_cursor, cities, chunk_size=500):
+    """Return {name: cities.id} for the given names, inserting unknown cities in bulk."""
+    names = list(dict.fromkeys(cities))
+    db_cursor.executemany('''
     INSERT OR IGNORE INTO cities (name) VALUES (?)
-    ''', (city,))
-    db_cursor.execute('''
-    SELECT id FROM cities WHERE name = ?
-    ''', (city,))
-    city_id = db_cursor.fetchone()[0]
-    
-    aqi_data = get_aqi_data(city)
-    if aqi_data and aqi_data.get('status') == 'ok':
-        city_data = {
-            'city_id': city_id,
-            'aqi': aqi_data['data']['aqi'],
-            'dominant_pollutant': aqi_data['data'].get('dominentpol', 'pm25'),
-            'forecasted_pm25_avg': aqi_data['data']['forecast']['daily']['pm25'][0].get('avg', 0),
-            'forecasted_pm10_avg': aqi_data['data']['forecast']['daily']['pm10'][0].get('avg', 0),
-            'forecasted_o3_avg': aqi_data['data']['forecast']['daily']['o3'][0].get('avg', 0)
-        }
-    else:
-        print(f"Failed to retrieve AQI data for {city}.")
+    ''', [(name,) for name in names])
+    city_ids = {}
+    for i in range(0, len(names), chunk_size):
+        chunk = names[i:i + chunk_size]
+        placeholders = ', '.join('?' * len(chunk))
+        db_cursor.execute(f'SELECT name, id FROM cities WHERE name IN ({placeholders})', chunk)
+        city_ids.update(db_cursor.fetchall())
+    return city_ids
+
+# Turn the raw AQI and weather payloads of one city into a combined record (aqi: AqiRecord already parsed, if any)
+@instrumentation.timed()
+def build_combined_city_data(city, city_id, aqi_data, weather_data, aqi=None):
+    """Parse the raw API payloads of a city into a CombinedRecord, or None on failure."""
+    if aqi is None:
+        aqi = parse_waqi_feed(city_id, aqi_data)
+    if aqi is None:
+        logger.debug("Failed to retrieve AQI data for %s.", city)
+        return None
+    weather = parse_owm_weather(city_id, weather_data)
+    if weather is None:
+        logger.debug("Failed to retrieve weather data for %s.", city)
         return None
+    return CombinedRecord(aqi, weather)
 
-    weather_data = get_weather_data_for_city(city)
-    if weather_data and weather_data.get('cod') == 200:
-        weather_info = {
-            'city_id': city_id,  # Store city_id
-            'temperature': weather_data['main']['temp'] - 273.15,  # Convert from Kelvin to Celsius
-            'weather_description': weather_data['weather'][0]['description'],
-            'humidity': weather_data['main']['humidity'],
-            'wind_speed': weather_data['wind']['speed']
-        }
-    else:
-        print(f"Failed to retrieve weather data for {city}.")
+# Run fetch under the provider's semaphore so no provider sees more than its limit
+def _limited_fetch(semaphore, fetch, city):
+    with semaphore:
+        return fetch(city)
+
+# Fetch a city's AQI payload, and its weather only when there is an AQI observation to pair it with
+# (OpenWeatherMap is not asked for e.g. an "Unknown station" city, which fails either way)
+def _fetch_city_pair(slots, city_id, city):
+    """Fetch a city's payloads under the provider limits; returns (parsed AqiRecord, aqi_data, weather_data)."""
+    aqi_slots, weather_slots = slots
+    aqi_data = _limited_fetch(aqi_slots, get_aqi_data, city)
+    aqi = parse_waqi_feed(city_id, aqi_data)
+    weather_data = _limited_fetch(weather_slots, get_weather_data_for_city, city) if aqi else None
+    return aqi, aqi_data, weather_data
+
+# Fetch AQI and weather payloads for many cities at the same time, capped per provider by concurrency
+@instrumentation.timed()
+def fetch_city_payloads(cities, concurrency=None):
+    """Fetch AQI and weather data for all cities concurrently; returns {city: (aqi_data, weather_data)}."""
+    limits = dict(PROVIDER_CONCURRENCY, **(concurrency or {}))
+    slots = (threading.BoundedSemaphore(limits['waqi']), threading.BoundedSemaphore(limits['openweathermap']))
+
+    cities = list(dict.fromkeys(cities))
+    if not cities:
+        return {}
+    max_workers = min(limits['waqi'] + limits['openweathermap'], len(cities))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {city: pool.submit(_fetch_city_pair, slots, None, city) for city in cities}
+        payloads = {}
+        for city in cities:
+            _, aqi_data, weather_data = futures[city].result()
+            payloads[city] = (aqi_data, weather_data)
+    return payloads
+
+# Reduce a city's fetched payloads to the row write_city_micro_batch stores, so the payloads are never pickled
+def make_ingest_row(city_id, city, record, aqi_data, weather_data):
+    """Return (city_id, city, record, provider ids, unknown station flag) for write_city_micro_batch."""
+    return (city_id, city, record, provider_batch.extract_provider_ids(aqi_data, weather_data),
+            is_unknown_city_response(aqi_data))
+
+# Fetch and parse one city on a pipeline worker thread
+def _fetch_and_parse_city(slots, city_id, city):
+    """Fetch a city's payloads under the provider limits and parse them into an ingest row, or None if interrupted."""
+    try:
+        aqi, aqi_data, weather_data = _fetch_city_pair(slots, city_id, city)
+    except FetchInterrupted:
         return None
-    return {'city_data': city_data, 'weather_data': weather_info}
+    record = build_combined_city_data(city, city_id, aqi_data, weather_data, aqi)
+    return make_ingest_row(city_id, city, record, aqi_data, weather_data)
 
-# Retrieve and insert combined AQI and weather data for multiple cities (up to 25 at a time)
-def get_multiple_city_combined_data(city_requests, db_cursor, batch_size=25):
+# Write one micro-batch of parsed cities: rows, running averages, checkpoints and provider ids in one
+# unit of work. Records equal to the city's latest observation add no rows (see change_detection)
+@instrumentation.timed()
+def write_city_micro_batch(db_cursor, rows, window_seconds=COLLECTION_WINDOW):
+    """Store a micro-batch of make_ingest_row rows; returns (stored, failed, unchanged) city ids."""
+    combined_data = []
+    succeeded = {}
+    failed = {}
+    with unit_of_work(db_cursor.connection):
+        for city_id, city, record, _, unknown_station in rows:
+            if record:
+                combined_data.append(record)
+                succeeded[city_id] = max(record.aqi.observed_at, record.weather.observed_at)
+            elif unknown_station:
+                logger.info("Skipping %s: no AQI station found, remembering it as invalid.", city)
+                mark_invalid(db_cursor, city, 'Unknown station')
+            else:
+                logger.info("Skipping %s due to data retrieval failure.", city)
+                failed[city_id] = 'data retrieval failure'
+        changed, unchanged = change_detection.split_changed(db_cursor, combined_data)
+        if changed:
+            batch_id = insert_combined_data(db_cursor, [record for record, _ in changed])
+            change_detection.remember(db_cursor, changed, batch_id)
+            update_average_temperature(db_cursor)
+        record_fetch_results(db_cursor, succeeded, failed, window_seconds)
+        provider_batch.record_provider_ids(db_cursor, [(city_id, provider_ids)
+                                                       for city_id, _, _, provider_ids, _ in rows])
+    unchanged_ids = [record.aqi.city_id for record in unchanged]
+    skipped = set(unchanged_ids)
+    return [city_id for city_id in succeeded if city_id not in skipped], list(failed), unchanged_ids
+
+# Flush target of streaming.MicroBatcher for the ingest paths, keeping their totals
+class IngestWriter:
+    """Write micro-batches through write_city_micro_batch and count stored, unchanged and failed cities."""
+
+    def __init__(self, db_cursor, window_seconds=COLLECTION_WINDOW):
+        self.db_cursor = db_cursor
+        self.window_seconds = window_seconds
+        self.stored = 0
+        self.failed = 0
+        self.unchanged = 0
+
+    def __call__(self, rows):
+        stored, failed, unchanged = write_city_micro_batch(self.db_cursor, rows, self.window_seconds)
+        self.stored += len(stored)
+        self.failed += len(failed)
+        self.unchanged += len(unchanged)
+
+    def log_summary(self, attempted, remaining, micro_batches, workers=None):
+        """Log the outcome of one ingest batch; workers is the number of worker processes, if any."""
+        extra = {'ingested': self.stored, 'unchanged': self.unchanged, 'failed': self.failed,
+                 'remaining': remaining, 'micro_batches': micro_batches}
+        across = ''
+        if workers is not None:
+            extra['workers'] = workers
+            across = f' across {workers} worker processes'
+        logger.info("Ingested %d of %d cities (%d unchanged, %d failed)%s; %d cities are still due.", self.stored,
+                    attempted, self.unchanged, self.failed, across, remaining, extra=extra)
+
+# Retrieve and insert combined AQI and weather data for multiple cities (up to 25 at a time). The requests
+# become a work queue of canonical cities (see city_registry); worker threads fetch and parse them within a
+# bounded window (see streaming.bounded_map) while this thread writes micro-batches of flush_rows cities, or
+# sooner after flush_seconds. With batched=True, cities with known provider ids use the batch endpoints
+# (see provider_batch) and carry no forecast or dominant pollutant
+def get_multiple_city_combined_data(city_requests, db_cursor, batch_size=25, concurrency=None,
+                                    window_seconds=COLLECTION_WINDOW, batched=False,
+                                    flush_rows=streaming.FLUSH_ROWS, flush_seconds=streaming.FLUSH_SECONDS):
     """Retrieve and insert combined AQI and weather data for multiple cities, processing them in batches."""
-    start_index = get_last_processed_city_index()  # Get the last processed city index
-    total_cities = len(city_requests)
-    end_index = start_index + batch_size
-    cities_to_process = city_requests[start_index:end_index]
+    queue = build_city_work_queue(db_cursor, city_requests, window_seconds)
+    batch = queue[:batch_size]
 
-    combined_data = []
-    for city in cities_to_process:
-        print(f"Fetching combined data for {city}...")
-        data = get_combined_city_data(city, db_cursor)
-        if data:
-            combined_data.append(data)
-        else:
-            print(f"Skipping {city} due to data retrieval failure.")
-    
-    if combined_data:
-        insert_combined_data(db_cursor, combined_data)
-        set_last_processed_city_index(end_index)  # Update progress file to the next batch
-
-    if end_index >= total_cities:
-        print("All cities have been processed.")
-    else:
-        print(f"Processed cities up to {city_requests[end_index-1]}. Next batch will start from {city_requests[end_index]}.")
+    batched_data = provider_batch.fetch_batched_city_data(db_cursor, batch) if batched else {}
+    cities_to_process = [(city_id, name) for city_id, name in batch if city_id not in batched_data]
+    logger.debug("Fetching combined data for %d cities (%d through batch endpoints)...", len(batch), len(batched_data))
 
+    limits = dict(PROVIDER_CONCURRENCY, **(concurrency or {}))
+    slots = (threading.BoundedSemaphore(limits['waqi']), threading.BoundedSemaphore(limits['openweathermap']))
+    writer = IngestWriter(db_cursor, window_seconds)
+    interrupted = 0
+
+    with streaming.MicroBatcher(writer, flush_rows, flush_seconds) as batcher:
+        for city_id, city in batch:
+            if city_id in batched_data:
+                batcher.add((city_id, city, batched_data[city_id], None, False))
+        if cities_to_process:
+            results = streaming.bounded_map(lambda item: _fetch_and_parse_city(slots, *item), cities_to_process,
+                                            max_workers=min(limits['waqi'] + limits['openweathermap'],
+                                                            len(cities_to_process)),
+                                            idle_timeout=flush_seconds)
+            for result in results:
+                if result is streaming.IDLE:
+                    batcher.tick()
+                    continue
+                if result[1] is None:
+                    # Not checkpointed at all, so the city is neither failed nor backed off
+                    interrupted += 1
+                    continue
+                batcher.add(result[1])
+
+    attempted = len(batch) - interrupted
+    remaining = max(len(queue) - len(batch), 0) + interrupted
+    writer.log_summary(attempted, remaining, batcher.flushes)
+    return attempted, remaining
+
+# temperature_sum, temperature_count and last_weather_id let calculations.update_average_temperature
+# fold in only new rows
 def create_avg_temperature_table(db_cursor):
     """Create the table to store average temperatures using city_id."""
     db_cursor.execute('''
     CREATE TABLE IF NOT EXISTS city_avg_temperature (
         city_id INTEGER PRIMARY KEY,
         avg_temperature REAL,
+        temperature_sum REAL,
+        temperature_count INTEGER,
+        last_weather_id INTEGER,
+        FOREIGN KEY(city_id) REFERENCES cities(id)
+    )
+    ''')
+    logger.debug("Table city_avg_temperature created or already exists.")
+
+# value_sum, sample_count and last_weather_id are the running aggregates calculations.refresh_pollutant_summary
+# folds new rows into
+def create_pollutant_summary_table(db_cursor):
+    """Create the table holding per-city weather metric averages for each dominant pollutant."""
+    db_cursor.execute('''
+    CREATE TABLE IF NOT EXISTS city_pollutant_summary (
+        city_id INTEGER,
+        pollutant INTEGER,
+        metric TEXT,
+        avg_value REAL,
+        value_sum REAL,
+        sample_count INTEGER,
+        last_weather_id INTEGER,
+        PRIMARY KEY (city_id, pollutant, metric),
+        FOREIGN KEY(city_id) REFERENCES cities(id),
+        FOREIGN KEY(pollutant) REFERENCES pollutants(id)
+    )
+    ''')
+
+# last_batch_id is the newest batch folded in, so calculations.refresh_observation_summary only recomputes
+# cities with new batches
+def create_observation_summary_table(db_cursor):
+    """Create the materialized per-city averages of paired AQI and weather observations."""
+    db_cursor.execute('''
+    CREATE TABLE IF NOT EXISTS city_observation_summary (
+        city_id INTEGER PRIMARY KEY,
+        observation_count INTEGER,
+        avg_aqi REAL,
+        avg_forecasted_pm25 REAL,
+        avg_forecasted_pm10 REAL,
+        avg_forecasted_o3 REAL,
+        avg_humidity REAL,
+        avg_wind_speed REAL,
+        avg_temperature REAL,
+        last_batch_id INTEGER,
         FOREIGN KEY(city_id) REFERENCES cities(id)
     )
     ''')
-    db_cursor.connection.commit()
-    print("Table city_avg_temperature created or already exists.")
-
-def get_last_processed_city_index(progress_file="last_processed_city.txt"):
-    """Retrieve the index of the last processed city from the file."""
-    if os.path.exists(progress_file): # Got this structre from ChatGPT
-        with open(progress_file, 'r') as f:
-            try:
-                return int(f.read().strip()) 
-            except ValueError:
-                return 0
-    return 0  # Default to start from the beginning if the file doesn't exist
-
-def set_last_processed_city_index(index, progress_file="last_processed_city.txt"):
-    """Store the index of the last processed city into the file."""
-    with open(progress_file, 'w') as f:
-        f.write(str(index))
\ No newline at end of file
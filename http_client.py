@@ -0,0 +1,197 @@
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeouts in seconds for every provider request
+TIMEOUT = (3.05, 15)
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Pools are kept per host, so this only needs to cover the providers we call
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+_session = None
+_session_lock = threading.Lock()
+_stats_lock = threading.Lock()
+# Latency percentiles are taken over the most recent requests only, so long-running collectors stay bounded
+LATENCY_SAMPLES = 10000
+
+_stats = {'requests': 0, 'retries': 0, 'failures': 0, 'bytes_received': 0,
+          'latencies': deque(maxlen=LATENCY_SAMPLES)}
+# Connection counts merged from other processes (see merge_stats), and the counts already drained from this one
+_merged_connections = {'opened': 0, 'served': 0}
+_drained_connections = {'opened': 0, 'served': 0}
+
+
+def get_session():
+    """Return the shared keep-alive session used for all provider requests."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def close_session():
+    """Close the shared session and its connection pools."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def _retry_after_seconds(response):
+    """Parse a Retry-After header (seconds or HTTP date), or return None."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff_delay(attempt):
+    """Full-jitter exponential backoff for the given retry attempt."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _record(latency=None, retried=False, failed=False, nbytes=0):
+    with _stats_lock:
+        if latency is not None:
+            _stats['requests'] += 1
+            _stats['latencies'].append(latency)
+        if retried:
+            _stats['retries'] += 1
+        if failed:
+            _stats['failures'] += 1
+        _stats['bytes_received'] += nbytes
+
+
+def get(url, timeout=TIMEOUT, max_retries=MAX_RETRIES):
+    """GET a URL through the shared session, retrying timeouts, 429 and 5xx responses.
+
+    Returns the final response (which may still be an error status), or raises the
+    last requests exception once retries are exhausted.
+    """
+    session = get_session()
+    attempt = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            response = session.get(url, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            _record(latency=time.perf_counter() - start)
+            if attempt >= max_retries:
+                _record(failed=True)
+                raise
+            _record(retried=True)
+            time.sleep(_backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        _record(latency=time.perf_counter() - start, nbytes=len(response.content))
+        if response.status_code not in RETRY_STATUSES or attempt >= max_retries:
+            if response.status_code >= 400:
+                _record(failed=True)
+            return response
+
+        delay = _retry_after_seconds(response)
+        if delay is None:
+            delay = _backoff_delay(attempt)
+        _record(retried=True)
+        response.close()
+        time.sleep(min(delay, BACKOFF_MAX))
+        attempt += 1
+
+
+def _connection_counts():
+    """Sum (connections opened, requests served) over all live urllib3 pools."""
+    opened = served = 0
+    if _session is None:
+        return opened, served
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                served += pool.num_requests
+    return opened, served
+
+
+def get_stats():
+    """Return request, retry, connection reuse and latency counters (latencies of the last LATENCY_SAMPLES requests)."""
+    with _stats_lock:
+        latencies = sorted(_stats['latencies'])
+        stats = {key: value for key, value in _stats.items() if key != 'latencies'}
+    opened, served = _connection_counts()
+    opened += _merged_connections['opened']
+    served += _merged_connections['served']
+    stats['connections_opened'] = opened
+    stats['connections_reused'] = max(0, served - opened)
+    if latencies:
+        stats['latency_avg'] = sum(latencies) / len(latencies)
+        stats['latency_p50'] = latencies[len(latencies) // 2]
+        stats['latency_p99'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        stats['latency_max'] = latencies[-1]
+    return stats
+
+
+def reset_stats():
+    """Clear all counters."""
+    with _stats_lock:
+        _stats.update({'requests': 0, 'retries': 0, 'failures': 0, 'bytes_received': 0,
+                       'latencies': deque(maxlen=LATENCY_SAMPLES)})
+        _merged_connections.update({'opened': 0, 'served': 0})
+
+
+def drain_stats():
+    """Return the raw counters recorded since the last drain and clear them, for merge_stats in another process."""
+    opened, served = _connection_counts()
+    with _stats_lock:
+        drained = dict(_stats, latencies=list(_stats['latencies']),
+                       connections_opened=opened - _drained_connections['opened'],
+                       connections_served=served - _drained_connections['served'])
+        _stats.update({'requests': 0, 'retries': 0, 'failures': 0, 'bytes_received': 0,
+                       'latencies': deque(maxlen=LATENCY_SAMPLES)})
+        _drained_connections.update({'opened': opened, 'served': served})
+    return drained
+
+
+def merge_stats(drained):
+    """Add counters returned by drain_stats (e.g. in a worker process) to this process's."""
+    with _stats_lock:
+        for key in ('requests', 'retries', 'failures', 'bytes_received'):
+            _stats[key] += drained[key]
+        _stats['latencies'].extend(drained['latencies'])
+        _merged_connections['opened'] += drained['connections_opened']
+        _merged_connections['served'] += drained['connections_served']
+
+
+def format_stats():
+    """One-line human readable summary of get_stats()."""
+    stats = get_stats()
+    summary = (f"HTTP: {stats['requests']} requests, {stats['retries']} retries, {stats['failures']} failures, "
+               f"{stats['connections_opened']} connections opened, {stats['connections_reused']} reused")
+    if 'latency_avg' in stats:
+        summary += (f", avg latency {stats['latency_avg'] * 1000:.0f} ms"
+                    f", p99 {stats['latency_p99'] * 1000:.0f} ms")
+    return summary
+
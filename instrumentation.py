@@ -0,0 +1,198 @@
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import pstats
+import threading
+import time
+
+# Off by default so library use and benchmarks pay nothing; main.main enables it
+_enabled = False
+_lock = threading.Lock()
+_timings = {}
+_statements = {}
+_started_at = time.perf_counter()
+
+
+def enable():
+    """Start recording timings and DB statements."""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Forget everything recorded so far."""
+    global _started_at
+    with _lock:
+        _timings.clear()
+        _statements.clear()
+        _started_at = time.perf_counter()
+
+
+def record(name, seconds):
+    """Add one call of `name` that took `seconds` of wall time."""
+    if not _enabled:
+        return
+    with _lock:
+        entry = _timings.get(name)
+        if entry is None:
+            _timings[name] = [1, seconds, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+
+def drain():
+    """Return the timings and statement counts recorded since the last drain and clear them.
+
+    The started-at time is kept; the result is meant for merge in another
+    process, e.g. the parent of a worker process.
+    """
+    with _lock:
+        drained = {'timings': {name: list(entry) for name, entry in _timings.items()},
+                   'statements': dict(_statements)}
+        _timings.clear()
+        _statements.clear()
+    return drained
+
+
+def merge(drained):
+    """Add timings and statement counts returned by drain to this process's."""
+    if not _enabled:
+        return
+    with _lock:
+        for name, (calls, total, longest) in drained['timings'].items():
+            entry = _timings.get(name)
+            if entry is None:
+                _timings[name] = [calls, total, longest]
+            else:
+                entry[0] += calls
+                entry[1] += total
+                entry[2] = max(entry[2], longest)
+        for kind, count in drained['statements'].items():
+            _statements[kind] = _statements.get(kind, 0) + count
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time the enclosed block as one call of `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def timed(name=None):
+    """Decorator recording wall time and call count of a function under `name` (default: its qualified name)."""
+    def decorator(function):
+        label = name or f'{function.__module__}.{function.__qualname__}'
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(label, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def _count_statement(sql):
+    if not _enabled:
+        return
+    kind = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'EMPTY'
+    with _lock:
+        _statements[kind] = _statements.get(kind, 0) + 1
+
+
+def trace_connection(connection):
+    """Count every statement the connection runs, by its leading keyword (SELECT, INSERT, ...)."""
+    connection.set_trace_callback(_count_statement)
+    return connection
+
+
+@contextlib.contextmanager
+def profile(path=None):
+    """Run the enclosed block under cProfile and dump pstats to `path` (nothing happens when path is None).
+
+    cProfile only sees the calling thread: work on pool threads (fetching and
+    parsing) and in other processes (shard workers, plots) shows up as the
+    time the caller spent waiting for it. Use the timings report for those.
+    """
+    if path is None:
+        yield None
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+def build_report(extra=None):
+    """Return the recorded timings and statement counts as a JSON-serializable dict.
+
+    extra is merged in under its own keys, e.g. HTTP and cache counters.
+    """
+    with _lock:
+        timings = {name: {'calls': calls, 'total_s': total, 'avg_ms': total / calls * 1000, 'max_ms': longest * 1000}
+                   for name, (calls, total, longest) in _timings.items()}
+        statements = dict(_statements)
+        elapsed = time.perf_counter() - _started_at
+    report = {'elapsed_s': elapsed, 'timings': timings, 'db_statements': statements,
+              'db_statements_total': sum(statements.values())}
+    report.update(extra or {})
+    return report
+
+
+def format_report(report):
+    """Render build_report() as an aligned text table, slowest entries first."""
+    width = max([len('stage / function')] + [len(name) for name in report['timings']])
+    lines = [f"Run took {report['elapsed_s']:.2f} s",
+             f"{'stage / function':{width}} {'calls':>8} {'total s':>10} {'avg ms':>10} {'max ms':>10}"]
+    for name, entry in sorted(report['timings'].items(), key=lambda item: -item[1]['total_s']):
+        lines.append(f"{name:{width}} {entry['calls']:8d} {entry['total_s']:10.3f} {entry['avg_ms']:10.2f} "
+                     f"{entry['max_ms']:10.2f}")
+    statements = ', '.join(f"{kind} {count}" for kind, count in sorted(report['db_statements'].items(),
+                                                                         key=lambda item: -item[1]))
+    lines.append(f"DB statements: {report['db_statements_total']} ({statements or 'none'})")
+    for key, value in report.items():
+        if key not in ('elapsed_s', 'timings', 'db_statements', 'db_statements_total'):
+            lines.append(f"{key}: {json.dumps(value, default=str)}")
+    return '\n'.join(lines)
+
+
+def write_report(json_path, text_path=None, extra=None):
+    """Write the report as JSON (and optionally as text) and return the text form."""
+    report = build_report(extra)
+    with open(json_path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    text = format_report(report)
+    if text_path:
+        with open(text_path, 'w') as f:
+            f.write(text + '\n')
+    return text
+
+
+def format_top_functions(profile_path, limit=25):
+    """Return the functions with the highest cumulative time from a pstats dump as text."""
+    stream = io.StringIO()
+    pstats.Stats(profile_path, stream=stream).sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
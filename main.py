@@ -1,73 +1,223 @@
-import sqlite3
-from file_functions import create_combined_tables, get_multiple_city_combined_data, create_avg_temperature_table
-from calculations import calculate_and_store_average_temperature_for_pollutant_1
+import argparse
+import contextlib
+import logging
+import os
+from db import close_pools, connect_db, unit_of_work
+from file_functions import get_multiple_city_combined_data, create_avg_temperature_table
+from migrations import ensure_schema
+from calculations import (calculate_and_store_average_temperature_for_pollutant_1, refresh_observation_summary,
+                          refresh_pollutant_summary)
 import visualizations
+import analytics
+import timeseries
+import columnar_store
+import collector
+import sharded_ingest
+import change_detection
+import threading
+import time
+from city_registry import COLLECTION_WINDOW
+import http_client
+import response_cache
+import query_cache
+import instrumentation
+import structured_logging
+from dictionary_encoding import warm_dictionaries
 
-def show_table(output_file):
-    """Display the city_avg_temperature table."""
-    connection = sqlite3.connect('global_combined_data.db')
-    cursor = connection.cursor()
-    cursor.execute("SELECT * FROM city_avg_temperature")
-    rows = cursor.fetchall()
-
-    with open(output_file, "a") as file:
-        file.write("\nCity Average Temperatures Table:\n")
-        for row in rows:
-            file.write(f"{row}\n")
-    connection.close()
-
-def fetch_average_temperatures(output_file):
-    """Fetch and display average temperatures."""
-    connection = sqlite3.connect('global_combined_data.db')
-    cursor = connection.cursor()
-    cursor.execute("SELECT * FROM city_avg_temperature;")
-    rows = cursor.fetchall()
-
-    with open(output_file, "a") as file:
-        file.write("\nAverage Temperatures for Cities:\n")
-        for row in rows:
-            file.write(f"{row}\n")
-    connection.close()
-
-def main():
+logger = logging.getLogger(__name__)
+
+class ResultsReport:
+    """The run's results file, opened once and written through one buffered handle."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w', encoding='utf-8', buffering=64 * 1024)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_line(self, text):
+        self.file.write(f"{text}\n")
+
+    def write_query(self, title, cursor, query, params=()):
+        """Stream a query's rows into the report without materializing them; returns the row count."""
+        self.file.write(f"\n{title}:\n")
+        count = 0
+        for row in cursor.execute(query, params):
+            self.file.write(f"{row}\n")
+            count += 1
+        return count
+
+    def close(self):
+        self.file.close()
+
+def write_average_temperatures(report, cursor):
+    """Append the city_avg_temperature table to the results report."""
+    return report.write_query("Average Temperatures for Cities", cursor,
+                              "SELECT city_id, avg_temperature FROM city_avg_temperature ORDER BY city_id")
+
+def write_recent_rollups(report, cursor, now, days=7):
+    """Append the daily AQI and weather rollups of the most recently observed city to the results report."""
+    cursor.execute('SELECT city_id FROM city_aqi_data ORDER BY id DESC LIMIT 1')
+    row = cursor.fetchone()
+    if row is None:
+        return 0
+    count = 0
+    for source in timeseries.ROLLUPS:
+        rows = timeseries.fetch_range(cursor, source, row[0], now - days * timeseries.DAY, now + 1, timeseries.DAY)
+        report.write_line(f"\nDaily {source} rollups of city {row[0]} over the last {days} days:")
+        for rollup in rows:
+            report.write_line(str(rollup))
+        count += len(rows)
+    return count
+
+# Cities to collect; duplicates and spelling variants are merged by city_registry
+city_requests = [
+    "New York", "Tokyo", "Paris", "London", "Sydney", "Berlin", "Rome", "Madrid", "Moscow", "Dubai",
+    "Los Angeles", "Shanghai", "São Paulo", "Cairo", "Buenos Aires", "Bangkok", "Istanbul", "Singapore", "Toronto", "Mexico City",
+    "Hong Kong", "Seoul", "Lagos", "Cape Town", "Mumbai", "Rio de Janeiro", "Kuala Lumpur", "Beijing", "Vienna", "Vienna",
+    "Jakarta", "Lagos", "Melbourne", "Karachi", "San Francisco", "Dubai", "Lima", "Jakarta", "Manila", "Rio de Janeiro",
+    "Lagos", "Cape Town", "Oslo", "Geneva", "Madrid", "Paris", "Berlin", "Helsinki", "Kiev", "Athens", "Lisbon", "Rome", "Amsterdam",
+    "Hong Kong", "Bangkok", "Bangladesh", "Dubai", "Toronto", "Los Angeles", "Chicago", "London", "Dubai", "Cairo", "Singapore", "Mumbai",
+    "Toronto", "Sydney", "Milan", "Rome", "Barcelona", "Mexico City", "Vienna", "Shanghai", "Istanbul", "Seoul", "Bangkok", "Cape Town", 
+    "Berlin", "Tokyo", "Buenos Aires", "Tokyo", "San Francisco", "Amsterdam", "Sao Paulo", "Dublin", "Mexico City", "Moscow", "Jakarta",
+    "San Diego", "Kuala Lumpur", "Santiago", "Helsinki", "Moscow", "Sydney", "Milan", "Manila", "Karachi", "Lagos", "Mumbai", "San Francisco", 
+    "Paris", "Los Angeles", "Madrid", "Berlin", "Rome", "Toronto", "Cairo", "Beijing", "Istanbul", "Bangkok", "Singapore", "Rio de Janeiro", 
+    "Jakarta", "Melbourne", "Mumbai", "Bangalore", "Vienna", "Seoul", "Oslo", "Berlin", "Geneva", "Barcelona", "Shanghai", "Rome", "London", 
+    "Paris", "Berlin", "Cairo", "Sydney", "Lagos", "Tokyo", "Mexico City", "San Francisco", "Düsseldorf", "Singapore", "Lisbon", "Athens", 
+    "Bangkok", "Sao Paulo", "Kuala Lumpur", "New York", "Dubai", "Moscow", "Rome", "Beijing", "Toronto", "Mexico City", "Cape Town", 
+    "Kiev", "Paris", "Los Angeles", "Istanbul", "Barcelona", "Dubai", "San Francisco", "Melbourne", "Moscow", "Buenos Aires", "Berlin", 
+    "London", "Madrid", "Shanghai", "Bangalore", "Rio de Janeiro", "Seoul", "Lagos", "Jakarta", "Berlin", "Rome", "Mumbai", "Sydney", 
+    "Cape Town", "Paris", "Vienna", "Helsinki", "Kuala Lumpur", "London", "Santiago", "Los Angeles", "Toronto", "San Francisco", "Istanbul"
+]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Collect AQI and weather data, compute averages and plot them.")
+    parser.add_argument('--rebuild-averages', action='store_true',
+                        help="verify the running averages against a full recomputation, then rebuild them")
+    parser.add_argument('--raw-retention-days', type=int, default=timeseries.RAW_RETENTION_DAYS,
+                        help="delete raw observations older than this after rolling them up (default: %(default)s)")
+    parser.add_argument('--hourly-retention-days', type=int, default=timeseries.HOURLY_RETENTION_DAYS,
+                        help="delete hourly rollups older than this (default: %(default)s)")
+    parser.add_argument('--collect', action='store_true',
+                        help="run as a long-lived collector that polls every city until SIGTERM")
+    parser.add_argument('--cadence', type=int, default=COLLECTION_WINDOW,
+                        help="seconds between polls of the same city (default: %(default)s)")
+    parser.add_argument('--batch-size', type=int, default=25, help="cities per ingest batch (default: %(default)s)")
+    parser.add_argument('--batched', action='store_true',
+                        help="use the WAQI bounds and OpenWeatherMap group endpoints for cities with known ids")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="fetch and parse in this many processes, sharded by city name, with this process "
+                             "as the only DB writer (one-off runs only; default: %(default)s)")
+    parser.add_argument('--report', default='run_report.json',
+                        help="write per-stage timings, call counts and DB statement counts here as JSON "
+                             "(a .txt copy is written next to it; default: %(default)s)")
+    parser.add_argument('--profile', metavar='PATH',
+                        help="also run under cProfile and dump pstats to PATH (main thread only: fetch/parse pool "
+                             "threads and worker or plot processes appear as waiting time)")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="drop log records below this level (default: %(default)s)")
+    parser.add_argument('--log-format', default='text', choices=['text', 'json'],
+                        help="text lines or JSON lines (default: %(default)s)")
+    parser.add_argument('--log-file', help="append logs to this file instead of stderr")
+    return parser.parse_args(argv)
+
+def collect(args):
+    """Run the continuous collector until SIGTERM/SIGINT."""
+    stop_event = threading.Event()
+    collector.install_signal_handlers(stop_event)
+    with contextlib.closing(connect_db()) as conn:
+        cursor = conn.cursor()
+        ensure_schema(cursor)
+        warm_dictionaries(cursor)
+        collector.run_collector(cursor, city_requests, cadence=args.cadence, batch_size=args.batch_size,
+                                batched=args.batched, stop_event=stop_event)
+    logger.info(http_client.format_stats())
+    logger.info(response_cache.format_stats())
+
+def run_report_extra():
+    """HTTP and cache counters included in the run report."""
+    return {'http': http_client.get_stats(), 'response_cache': response_cache.get_stats(),
+            'query_cache': query_cache.get_stats()}
+
+def main(argv=None):
+    args = parse_args(argv)
+    structured_logging.configure_logging(args.log_level, json_lines=args.log_format == 'json', log_file=args.log_file)
+    if args.collect:
+        collect(args)
+        return
+    instrumentation.reset()
+    instrumentation.enable()
+    with instrumentation.profile(args.profile):
+        run(args)
+    text_path = os.path.splitext(args.report)[0] + '.txt'
+    logger.info("Run report:\n%s", instrumentation.write_report(args.report, text_path, run_report_extra()))
+    if args.profile:
+        logger.info("cProfile stats written to %s (inspect with python -m pstats %s); top functions:\n%s",
+                    args.profile, args.profile, instrumentation.format_top_functions(args.profile))
+
+def run(args):
+    """One scheduled run: ingest, aggregate, prune, export and plot, each timed as a stage.
+
+    Every stage writes through one connection, each ingest batch and each
+    aggregation step as its own unit of work; plotting reads through the
+    shared read-only pool.
+    """
     output_file = "average_temperature_results.txt"
-    city_requests = [
-        "New York", "Tokyo", "Paris", "London", "Sydney", "Berlin", "Rome", "Madrid", "Moscow", "Dubai",
-        "Los Angeles", "Shanghai", "São Paulo", "Cairo", "Buenos Aires", "Bangkok", "Istanbul", "Singapore", "Toronto", "Mexico City",
-        "Hong Kong", "Seoul", "Lagos", "Cape Town", "Mumbai", "Rio de Janeiro", "Kuala Lumpur", "Beijing", "Vienna", "Vienna",
-        "Jakarta", "Lagos", "Melbourne", "Karachi", "San Francisco", "Dubai", "Lima", "Jakarta", "Manila", "Rio de Janeiro",
-        "Lagos", "Cape Town", "Oslo", "Geneva", "Madrid", "Paris", "Berlin", "Helsinki", "Kiev", "Athens", "Lisbon", "Rome", "Amsterdam",
-        "Hong Kong", "Bangkok", "Bangladesh", "Dubai", "Toronto", "Los Angeles", "Chicago", "London", "Dubai", "Cairo", "Singapore", "Mumbai",
-        "Toronto", "Sydney", "Milan", "Rome", "Barcelona", "Mexico City", "Vienna", "Shanghai", "Istanbul", "Seoul", "Bangkok", "Cape Town", 
-        "Berlin", "Tokyo", "Buenos Aires", "Tokyo", "San Francisco", "Amsterdam", "Sao Paulo", "Dublin", "Mexico City", "Moscow", "Jakarta",
-        "San Diego", "Kuala Lumpur", "Santiago", "Helsinki", "Moscow", "Sydney", "Milan", "Manila", "Karachi", "Lagos", "Mumbai", "San Francisco", 
-        "Paris", "Los Angeles", "Madrid", "Berlin", "Rome", "Toronto", "Cairo", "Beijing", "Istanbul", "Bangkok", "Singapore", "Rio de Janeiro", 
-        "Jakarta", "Melbourne", "Mumbai", "Bangalore", "Vienna", "Seoul", "Oslo", "Berlin", "Geneva", "Barcelona", "Shanghai", "Rome", "London", 
-        "Paris", "Berlin", "Cairo", "Sydney", "Lagos", "Tokyo", "Mexico City", "San Francisco", "Düsseldorf", "Singapore", "Lisbon", "Athens", 
-        "Bangkok", "Sao Paulo", "Kuala Lumpur", "New York", "Dubai", "Moscow", "Rome", "Beijing", "Toronto", "Mexico City", "Cape Town", 
-        "Kiev", "Paris", "Los Angeles", "Istanbul", "Barcelona", "Dubai", "San Francisco", "Melbourne", "Moscow", "Buenos Aires", "Berlin", 
-        "London", "Madrid", "Shanghai", "Bangalore", "Rio de Janeiro", "Seoul", "Lagos", "Jakarta", "Berlin", "Rome", "Mumbai", "Sydney", 
-        "Cape Town", "Paris", "Vienna", "Helsinki", "Kuala Lumpur", "London", "Santiago", "Los Angeles", "Toronto", "San Francisco", "Istanbul"
-    ]
-    with sqlite3.connect('global_combined_data.db') as conn:
+    with contextlib.closing(connect_db()) as conn, ResultsReport(output_file) as report:
         cursor = conn.cursor()
-        create_combined_tables(cursor)
-        with open(output_file, "w") as file:
-            file.write("Creating table for average temperatures...\n")
-        
+        ensure_schema(cursor)
+        warm_dictionaries(cursor)
+        change_detection.load_index(cursor)
+        report.write_line("Creating table for average temperatures...")
         create_avg_temperature_table(cursor)
-        with open(output_file, "a") as file:
-            file.write("Fetching and inserting data for cities in batches...\n")
-        get_multiple_city_combined_data(city_requests, cursor, batch_size=25)
-
-        with open(output_file, "a") as file:
-            file.write("Calculating and storing average temperatures for cities with dominant_pollutant = 1...\n")
-        calculate_and_store_average_temperature_for_pollutant_1(cursor)
-        fetch_average_temperatures(output_file)
-        conn.commit()
-    show_table(output_file)
-    print(f"Process complete! Results are saved in {output_file}")
-    visualizations.main()
+
+        report.write_line("Fetching and inserting data for cities in batches...")
+        # A city is due again after --cadence seconds; never answer that poll from the previous one's responses
+        response_cache.MAX_TTL = args.cadence
+        with instrumentation.stage('stage.ingest'):
+            if args.workers > 1:
+                try:
+                    sharded_ingest.get_sharded_city_combined_data(city_requests, cursor, args.workers,
+                                                                  batch_size=args.batch_size,
+                                                                  window_seconds=args.cadence, batched=args.batched)
+                finally:
+                    sharded_ingest.shutdown_workers()
+            else:
+                get_multiple_city_combined_data(city_requests, cursor, batch_size=args.batch_size,
+                                                window_seconds=args.cadence, batched=args.batched)
+
+        report.write_line("Calculating and storing average temperatures for cities with dominant_pollutant = 1...")
+        with instrumentation.stage('stage.calculate'), unit_of_work(conn):
+            calculate_and_store_average_temperature_for_pollutant_1(cursor, full_rebuild=args.rebuild_averages)
+            refresh_observation_summary(cursor)
+            refresh_pollutant_summary(cursor, full_rebuild=args.rebuild_averages)
+            analytics.refresh_statistics(cursor)
+        write_average_temperatures(report, cursor)
+        now = int(time.time())
+        with instrumentation.stage('stage.prune'), unit_of_work(conn):
+            if timeseries.prune_observations(cursor, args.raw_retention_days, args.hourly_retention_days, now):
+                refresh_observation_summary(cursor, full_rebuild=True)
+        # The prune has just rolled up every pending row
+        write_recent_rollups(report, cursor, now)
+        if columnar_store.available():
+            # After the prune, so the snapshot the plots read holds the same rows as SQLite
+            with instrumentation.stage('stage.export'):
+                columnar_store.export_snapshot(cursor)
+                if args.raw_retention_days is not None:
+                    columnar_store.prune_snapshot(cursor, timeseries.raw_cutoff(args.raw_retention_days, now))
+    logger.info(http_client.format_stats())
+    logger.info(response_cache.format_stats())
+    logger.info("Process complete! Results are saved in %s", output_file)
+    try:
+        with instrumentation.stage('stage.plots'):
+            visualizations.main()
+    finally:
+        close_pools()
+    logger.info(query_cache.format_stats())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
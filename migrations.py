@@ -0,0 +1,166 @@
+import logging
+import sys
+
+from db import DB_PATH, connect_db, unit_of_work
+from file_functions import (create_combined_tables, create_avg_temperature_table, create_observation_summary_table,
+                            create_pollutant_summary_table)
+from analytics import create_statistics_tables
+from structured_logging import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Schema migrations for databases created by older versions of the pipeline,
+# applied in order and tracked with PRAGMA user_version. Each step spells out
+# its own DDL so later changes to create_combined_tables cannot alter what an
+# old migration does.
+
+def _add_indexes_and_wal(db_cursor):
+    """Switch to WAL and add the city_id and (dominant_pollutant, city_id) indexes."""
+    db_cursor.execute('PRAGMA journal_mode = WAL')
+    db_cursor.execute('CREATE INDEX IF NOT EXISTS idx_city_aqi_data_city ON city_aqi_data (city_id)')
+    db_cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_city_aqi_data_pollutant_city ON city_aqi_data (dominant_pollutant, city_id)
+    ''')
+    db_cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_city_weather_data_city ON city_weather_data (city_id, temperature)
+    ''')
+    db_cursor.execute('ANALYZE')
+
+def _add_column(db_cursor, table, column, declaration):
+    db_cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in db_cursor.fetchall()]:
+        db_cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+def _add_running_temperature_aggregates(db_cursor):
+    """Add running sum/count/watermark columns to city_avg_temperature and backfill them."""
+    if not table_exists(db_cursor, 'city_avg_temperature'):
+        return
+    _add_column(db_cursor, 'city_avg_temperature', 'temperature_sum', 'REAL')
+    _add_column(db_cursor, 'city_avg_temperature', 'temperature_count', 'INTEGER')
+    _add_column(db_cursor, 'city_avg_temperature', 'last_weather_id', 'INTEGER')
+    db_cursor.execute('''
+    UPDATE city_avg_temperature SET
+        temperature_sum = (SELECT TOTAL(temperature) FROM city_weather_data w WHERE w.city_id = city_avg_temperature.city_id),
+        temperature_count = (SELECT COUNT(temperature) FROM city_weather_data w WHERE w.city_id = city_avg_temperature.city_id),
+        last_weather_id = (SELECT MAX(id) FROM city_weather_data w WHERE w.city_id = city_avg_temperature.city_id)
+    ''')
+
+def _add_running_pollutant_aggregates(db_cursor):
+    """Add running sum and watermark columns to city_pollutant_summary; the next refresh rebuilds it."""
+    if not table_exists(db_cursor, 'city_pollutant_summary'):
+        return
+    _add_column(db_cursor, 'city_pollutant_summary', 'value_sum', 'REAL')
+    _add_column(db_cursor, 'city_pollutant_summary', 'last_weather_id', 'INTEGER')
+    # Rows written before this migration carry no watermark to resume from
+    db_cursor.execute('DELETE FROM city_pollutant_summary')
+
+def _split_latest_observation_hashes(db_cursor):
+    """Replace city_latest_observation's combined content hash with separate AQI and weather hashes."""
+    # Only an index of the last stored values; the next ingest stores every city once and rebuilds it
+    db_cursor.execute('DROP TABLE IF EXISTS city_latest_observation')
+
+def _add_observation_timestamps(db_cursor):
+    """Add observed_at to city_aqi_data and city_weather_data with (city_id, observed_at) indexes."""
+    _add_column(db_cursor, 'city_aqi_data', 'observed_at', 'INTEGER')
+    _add_column(db_cursor, 'city_weather_data', 'observed_at', 'INTEGER')
+    # Superseded by the (city_id, observed_at) index
+    db_cursor.execute('DROP INDEX IF EXISTS idx_city_aqi_data_city')
+    db_cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_city_aqi_data_city_time ON city_aqi_data (city_id, observed_at)
+    ''')
+    db_cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_city_weather_data_city_time ON city_weather_data (city_id, observed_at)
+    ''')
+
+def _add_fetch_checkpoints(db_cursor):
+    """Add per-city fetch status, retry and watermark columns to city_fetch_state."""
+    if not table_exists(db_cursor, 'city_fetch_state'):
+        return
+    _add_column(db_cursor, 'city_fetch_state', 'status', 'TEXT')
+    _add_column(db_cursor, 'city_fetch_state', 'attempts', 'INTEGER DEFAULT 0')
+    _add_column(db_cursor, 'city_fetch_state', 'last_attempt_at', 'INTEGER')
+    _add_column(db_cursor, 'city_fetch_state', 'next_attempt_at', 'INTEGER')
+    _add_column(db_cursor, 'city_fetch_state', 'last_observed_at', 'INTEGER')
+    _add_column(db_cursor, 'city_fetch_state', 'last_error', 'TEXT')
+    db_cursor.execute("UPDATE city_fetch_state SET status = 'ok' WHERE status IS NULL")
+
+def _add_observation_batches(db_cursor):
+    """Add batch_id to city_aqi_data and city_weather_data, pairing existing rows by per-city order."""
+    db_cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ingest_batches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started_at INTEGER,
+        city_count INTEGER
+    )
+    ''')
+    for table in ('city_aqi_data', 'city_weather_data'):
+        _add_column(db_cursor, table, 'batch_id', 'INTEGER REFERENCES ingest_batches(id)')
+        # Every run stored one AQI and one weather row per city, so the n-th rows of a city belong together
+        db_cursor.execute(f'''
+        UPDATE {table} SET batch_id = ordinals.n
+        FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY city_id ORDER BY id) AS n FROM {table}) AS ordinals
+        WHERE ordinals.id = {table}.id AND {table}.batch_id IS NULL
+        ''')
+    db_cursor.execute('''
+    INSERT OR IGNORE INTO ingest_batches (id, started_at, city_count)
+    SELECT batch_id, MIN(observed_at), COUNT(*) FROM city_aqi_data WHERE batch_id IS NOT NULL GROUP BY batch_id
+    ''')
+    db_cursor.execute('CREATE INDEX IF NOT EXISTS idx_city_aqi_data_batch ON city_aqi_data (batch_id)')
+    db_cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_city_weather_data_city_batch ON city_weather_data (city_id, batch_id)
+    ''')
+
+MIGRATIONS = [
+    _add_indexes_and_wal,
+    _add_running_temperature_aggregates,
+    _add_observation_timestamps,
+    _add_fetch_checkpoints,
+    _add_observation_batches,
+    _add_running_pollutant_aggregates,
+    _split_latest_observation_hashes,
+]
+
+def get_schema_version(db_cursor):
+    db_cursor.execute('PRAGMA user_version')
+    return db_cursor.fetchone()[0]
+
+def set_schema_version(db_cursor, version):
+    db_cursor.execute(f'PRAGMA user_version = {int(version)}')
+
+def table_exists(db_cursor, table):
+    db_cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return db_cursor.fetchone() is not None
+
+def migrate(db_cursor):
+    """Apply every migration newer than the database's user_version."""
+    version = get_schema_version(db_cursor)
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info("Applying migration %d: %s", number, migration.__doc__)
+        with unit_of_work(db_cursor.connection):
+            migration(db_cursor)
+            set_schema_version(db_cursor, number)
+    return get_schema_version(db_cursor)
+
+def ensure_schema(db_cursor):
+    """Bring the database up to the current schema, whether it is new or old."""
+    if table_exists(db_cursor, 'city_aqi_data'):
+        migrate(db_cursor)
+    else:
+        set_schema_version(db_cursor, len(MIGRATIONS))
+    with unit_of_work(db_cursor.connection):
+        create_combined_tables(db_cursor)
+        create_avg_temperature_table(db_cursor)
+        create_pollutant_summary_table(db_cursor)
+        create_observation_summary_table(db_cursor)
+        create_statistics_tables(db_cursor)
+    return get_schema_version(db_cursor)
+
+def main(db_path=DB_PATH):
+    configure_logging()
+    connection = connect_db(db_path)
+    version = ensure_schema(connection.cursor())
+    print(f"{db_path} is at schema version {version}.")
+    connection.close()
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,210 @@
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# Local stand-in for the WAQI and OpenWeatherMap endpoints we use, returning
+# realistic payloads with tunable latency, error rate and 429 throttling.
+# Point api_config.WAQI_BASE_URL and api_config.OWM_BASE_URL at it.
+
+POLLUTANTS = ['pm25', 'pm10', 'o3']
+DESCRIPTIONS = ['clear sky', 'few clouds', 'scattered clouds', 'broken clouds', 'overcast clouds',
+                'light rain', 'mist', 'haze']
+# Names starting with this are answered like a WAQI/OpenWeatherMap unknown city
+UNKNOWN_PREFIX = 'Invalid'
+
+
+def _city_rng(city):
+    """Deterministic per-city random generator, so a city always gets the same station."""
+    seed = int.from_bytes(hashlib.sha1(city.casefold().encode('utf-8')).digest()[:8], 'big')
+    return random.Random(seed)
+
+
+def city_profile(city):
+    """Static facts about a synthetic city: OpenWeatherMap id, WAQI uid and coordinates."""
+    rng = _city_rng(city)
+    return {
+        'owm_id': rng.randint(100000, 9999999),
+        'waqi_uid': rng.randint(1000, 99999),
+        'lat': round(rng.uniform(-60, 70), 4),
+        'lon': round(rng.uniform(-180, 180), 4),
+    }
+
+
+def waqi_feed_payload(city, now):
+    profile = city_profile(city)
+    rng = random.Random(f'{city}-{now // 3600}')  # readings change once per hour, like WAQI stations
+    observed = datetime.fromtimestamp(now - now % 3600, tz=timezone.utc)
+    daily = {pollutant: [{'avg': rng.randint(1, 150), 'day': observed.strftime('%Y-%m-%d'),
+                          'max': rng.randint(150, 250), 'min': rng.randint(0, 5)} for _ in range(3)]
+             for pollutant in POLLUTANTS}
+    return {
+        'status': 'ok',
+        'data': {
+            'aqi': rng.randint(5, 300),
+            'idx': profile['waqi_uid'],
+            'city': {'geo': [profile['lat'], profile['lon']], 'name': city, 'url': ''},
+            'dominentpol': rng.choice(POLLUTANTS),
+            'iaqi': {pollutant: {'v': rng.uniform(1, 100)} for pollutant in POLLUTANTS},
+            'time': {'s': observed.strftime('%Y-%m-%d %H:%M:%S'), 'tz': '+00:00',
+                     'v': int(observed.timestamp()), 'iso': observed.isoformat()},
+            'forecast': {'daily': daily},
+        },
+    }
+
+
+def owm_weather_payload(city, now):
+    profile = city_profile(city)
+    rng = random.Random(f'{city}-{now // 600}')  # OpenWeatherMap refreshes about every 10 minutes
+    temp = rng.uniform(250, 310)
+    return {
+        'coord': {'lon': profile['lon'], 'lat': profile['lat']},
+        'weather': [{'id': 800, 'main': 'Clouds', 'description': rng.choice(DESCRIPTIONS), 'icon': '01d'}],
+        'main': {'temp': temp, 'feels_like': temp - 1, 'pressure': 1013, 'humidity': rng.randint(10, 100)},
+        'wind': {'speed': round(rng.uniform(0, 15), 2), 'deg': rng.randint(0, 359)},
+        'dt': now - now % 600,
+        'id': profile['owm_id'],
+        'name': city,
+        'cod': 200,
+    }
+
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, keep-alive clients wait ~40 ms per response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+        if not server.take_token():
+            self._send_json(429, {'message': 'rate limit exceeded'}, {'Retry-After': '1'})
+            return
+        if server.error_rate and random.random() < server.error_rate:
+            self._send_json(503, {'message': 'service unavailable'})
+            return
+
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        now = int(time.time())
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+
+        if parts[:1] == ['feed'] and len(parts) >= 2:
+            city = parts[1]
+            if city.startswith(UNKNOWN_PREFIX):
+                self._send_json(200, {'status': 'error', 'data': 'Unknown station'})
+                return
+            server.remember(city)
+            self._send_json(200, waqi_feed_payload(city, now))
+        elif parts == ['map', 'bounds']:
+            lat1, lng1, lat2, lng2 = (float(value) for value in query['latlng'][0].split(','))
+            stations = []
+            for city in server.known_cities():
+                feed = waqi_feed_payload(city, now)['data']
+                lat, lon = feed['city']['geo']
+                if lat1 <= lat <= lat2 and lng1 <= lon <= lng2:
+                    stations.append({'lat': lat, 'lon': lon, 'uid': feed['idx'], 'aqi': str(feed['aqi']),
+                                     'station': {'name': city, 'time': feed['time']['iso']}})
+            self._send_json(200, {'status': 'ok', 'data': stations})
+        elif parts == ['data', '2.5', 'weather']:
+            city = query.get('q', [''])[0]
+            if not city or city.startswith(UNKNOWN_PREFIX):
+                self._send_json(404, {'cod': '404', 'message': 'city not found'})
+                return
+            server.remember(city)
+            self._send_json(200, owm_weather_payload(city, now))
+        elif parts == ['data', '2.5', 'group']:
+            ids = {int(value) for value in query.get('id', [''])[0].split(',') if value}
+            entries = [owm_weather_payload(city, now) for city in server.known_cities()
+                       if city_profile(city)['owm_id'] in ids]
+            for entry in entries:
+                del entry['cod']
+            self._send_json(200, {'cnt': len(entries), 'list': entries})
+        else:
+            self._send_json(404, {'message': 'not found'})
+
+
+class MockProviderServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, error_rate=0.0, rate_limit=None):
+        super().__init__(address, MockProviderHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self._tokens = rate_limit or 0
+        self._updated = time.monotonic()
+        self._cities = set()
+        self._lock = threading.Lock()
+
+    def take_token(self):
+        """Token bucket of rate_limit requests/second (burst of one second); False means answer 429."""
+        if not self.rate_limit:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._updated) * self.rate_limit)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def remember(self, city):
+        with self._lock:
+            self._cities.add(city)
+
+    def known_cities(self):
+        with self._lock:
+            return list(self._cities)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+def start_mock_server(port=0, latency=0.0, error_rate=0.0, rate_limit=None, host='127.0.0.1'):
+    """Start the mock server on a background thread and return it (call shutdown() to stop)."""
+    server = MockProviderServer((host, port), latency, error_rate, rate_limit)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the WAQI and OpenWeatherMap APIs.")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.05, help="mean response delay in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument('--rate-limit', type=float, default=None, help="requests/second before answering 429")
+    args = parser.parse_args()
+    server = MockProviderServer(('127.0.0.1', args.port), args.latency, args.error_rate, args.rate_limit)
+    print(f"Mock providers listening on {server.base_url}")
+    print(f"  export WAQI_BASE_URL={server.base_url} OWM_BASE_URL={server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import json
+from collections import namedtuple
+
+from timeseries import owm_observed_at, waqi_observed_at
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the standard library decoder is used instead
+    orjson = None
+
+# Fields in column order of city_aqi_data / city_weather_data (without id and batch_id).
+# dominant_pollutant and weather_description still hold the provider's names;
+# insert_combined_data builds the rows from them, dictionary-encoding those names into
+# lookup ids and adding the batch_id.
+AqiRecord = namedtuple('AqiRecord', [
+    'city_id', 'observed_at', 'aqi', 'dominant_pollutant',
+    'forecasted_pm25_avg', 'forecasted_pm10_avg', 'forecasted_o3_avg',
+])
+WeatherRecord = namedtuple('WeatherRecord', [
+    'city_id', 'observed_at', 'temperature', 'weather_description', 'humidity', 'wind_speed',
+])
+# One city's AQI and weather observation, the unit of insert_combined_data
+CombinedRecord = namedtuple('CombinedRecord', ['aqi', 'weather'])
+
+KELVIN_OFFSET = 273.15
+# Builds a record from a ready tuple of fields, skipping the namedtuple __new__ wrapper (parse_records is hot)
+_new_record = tuple.__new__
+
+
+def loads(data):
+    """Decode a JSON document (bytes or str), with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _to_float(value):
+    value_type = type(value)
+    if value_type is float:
+        return value
+    if value_type is int:
+        return float(value)
+    if value is None or value_type is bool:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value):
+    if type(value) is int:
+        return value
+    try:
+        return int(_to_float(value))
+    except (TypeError, ValueError, OverflowError):  # None, NaN, infinity
+        return None
+
+
+def _lookup(value, *keys):
+    """Follow keys/indexes into nested JSON, or None as soon as one is missing or the wrong type."""
+    try:
+        for key in keys:
+            value = value[key]
+    except (KeyError, IndexError, TypeError):
+        return None
+    return value
+
+
+def parse_waqi_feed(city_id, payload):
+    """Parse a WAQI feed payload into an AqiRecord, or None if it holds no observation.
+
+    Only status 'ok' payloads with a data object are accepted. Anything else that
+    is missing or malformed (a '-' aqi, absent forecast series, no dominant
+    pollutant) becomes None and is stored as NULL.
+    """
+    if not isinstance(payload, dict) or payload.get('status') != 'ok':
+        return None
+    data = payload.get('data')
+    if not isinstance(data, dict):
+        return None
+    observed_at = waqi_observed_at(data)
+    # Complete payloads are read in one go; only when a lookup fails is each field looked up on its own
+    try:
+        daily = data['forecast']['daily']
+        return _new_record(AqiRecord, (city_id, observed_at, _to_int(data['aqi']), data['dominentpol'] or None,
+                                       _to_float(daily['pm25'][0]['avg']), _to_float(daily['pm10'][0]['avg']),
+                                       _to_float(daily['o3'][0]['avg'])))
+    except (KeyError, IndexError, TypeError):
+        return AqiRecord(city_id, observed_at, _to_int(data.get('aqi')), data.get('dominentpol') or None,
+                         _to_float(_lookup(data, 'forecast', 'daily', 'pm25', 0, 'avg')),
+                         _to_float(_lookup(data, 'forecast', 'daily', 'pm10', 0, 'avg')),
+                         _to_float(_lookup(data, 'forecast', 'daily', 'o3', 0, 'avg')))
+
+
+def parse_owm_weather(city_id, payload):
+    """Parse an OpenWeatherMap current-weather object into a WeatherRecord, or None.
+
+    Accepts both single-city responses (cod 200) and the entries of a group
+    response (no cod). The temperature is converted from Kelvin to Celsius;
+    missing fields become None.
+    """
+    if not isinstance(payload, dict) or payload.get('cod', 200) != 200:
+        return None
+    try:
+        main = payload['main']
+        temperature = _to_float(main['temp'])
+        humidity = _to_int(main['humidity'])
+        description = payload['weather'][0]['description']
+        wind_speed = _to_float(payload['wind']['speed'])
+    except (KeyError, IndexError, TypeError):
+        temperature = _to_float(_lookup(payload, 'main', 'temp'))
+        humidity = _to_int(_lookup(payload, 'main', 'humidity'))
+        description = _lookup(payload, 'weather', 0, 'description')
+        wind_speed = _to_float(_lookup(payload, 'wind', 'speed'))
+    return _new_record(WeatherRecord, (
+        city_id,
+        owm_observed_at(payload),
+        temperature - KELVIN_OFFSET if temperature is not None else None,
+        description,
+        humidity,
+        wind_speed,
+    ))
@@ -0,0 +1,262 @@
+import json
+import math
+import os
+from urllib.parse import parse_qs, urlsplit
+
+import api_config
+from parsers import AqiRecord, CombinedRecord, parse_owm_weather
+from timeseries import waqi_observed_at
+
+# OpenWeatherMap accepts at most 20 city ids per group request
+OWM_GROUP_SIZE = 20
+# Cities are grouped into square tiles of this many degrees, one WAQI bounds request per tile
+TILE_DEGREES = 10
+# Padding around each tile so cities near its edge still see their closest stations
+TILE_PADDING = 0.5
+# A station further than this from the city centre (in km) is not used for it
+MAX_STATION_DISTANCE_KM = 30
+# Recorded WAQI map/bounds and OpenWeatherMap group responses replayed by check_fixtures
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Cities replayed by check_fixtures: name -> ((owm_id, waqi_uid, lat, lon), expected
+# (aqi, temperature in C, humidity, wind speed), or None when the batch endpoints cannot answer)
+FIXTURE_CITIES = {
+    'London': ((2643743, 5724, 51.5085, -0.1257), (42, 10.95, 76, 4.6)),
+    'Paris': ((2988507, None, 48.8534, 2.3488), (55, 13.15, 70, 3.1)),  # nearest station, not Bobigny
+    'Tokyo': ((1850147, 1419, 35.6895, 139.6917), (61, 18.05, 64, 2.7)),
+    'Berlin': ((2950159, 6132, 52.5244, 13.4105), (38, 8.35, 81, 5.2)),
+    'Rome': ((3169070, None, 41.8947, 12.4839), (47, 20.25, 58, 1.9)),
+    'Madrid': ((3117735, 5725, 40.4165, -3.7026), (33, 21.85, 41, 3.6)),
+    'New York': ((None, 3307, 40.7143, -74.006), None),  # OpenWeatherMap id not learned yet
+    'Reykjavik': ((3413829, None, 64.1355, -21.8954), None),  # no recorded station or weather
+}
+
+
+def create_provider_id_table(db_cursor):
+    """Create the table of provider ids and coordinates learned for each city."""
+    db_cursor.execute('''
+    CREATE TABLE IF NOT EXISTS city_provider_ids (
+        city_id INTEGER PRIMARY KEY,
+        owm_id INTEGER,
+        waqi_uid INTEGER,
+        lat REAL,
+        lon REAL,
+        FOREIGN KEY(city_id) REFERENCES cities(id)
+    )
+    ''')
+
+
+def extract_provider_ids(aqi_data, weather_data):
+    """Return (owm_id, waqi_uid, lat, lon) from a city's single-city payloads, or None if neither id is there."""
+    owm_id = lat = lon = waqi_uid = None
+    if weather_data and weather_data.get('cod') == 200:
+        owm_id = weather_data.get('id')
+        coord = weather_data.get('coord') or {}
+        lat, lon = coord.get('lat'), coord.get('lon')
+    if aqi_data and aqi_data.get('status') == 'ok':
+        waqi_uid = aqi_data['data'].get('idx')
+        geo = (aqi_data['data'].get('city') or {}).get('geo')
+        if lat is None and geo:
+            lat, lon = geo
+    if owm_id is None and waqi_uid is None:
+        return None
+    return owm_id, waqi_uid, lat, lon
+
+
+def record_provider_ids(db_cursor, city_provider_ids):
+    """Store OpenWeatherMap ids, WAQI station uids and coordinates learned from single-city payloads.
+
+    city_provider_ids is an iterable of (city_id, ids) with ids as returned by
+    extract_provider_ids; None entries are skipped. Ids only need to be learned
+    once; later runs can use the batch endpoints for those cities.
+    """
+    rows = [(city_id, *ids) for city_id, ids in city_provider_ids if ids is not None]
+    db_cursor.executemany('''
+    INSERT INTO city_provider_ids (city_id, owm_id, waqi_uid, lat, lon) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(city_id) DO UPDATE SET
+        owm_id = COALESCE(excluded.owm_id, owm_id),
+        waqi_uid = COALESCE(excluded.waqi_uid, waqi_uid),
+        lat = COALESCE(excluded.lat, lat),
+        lon = COALESCE(excluded.lon, lon)
+    ''', rows)
+
+
+def load_provider_ids(db_cursor, city_ids):
+    """Return {city_id: (owm_id, waqi_uid, lat, lon)} for cities whose ids are fully known."""
+    db_cursor.execute('''
+    SELECT city_id, owm_id, waqi_uid, lat, lon FROM city_provider_ids
+    WHERE owm_id IS NOT NULL AND lat IS NOT NULL AND lon IS NOT NULL
+    ''')
+    wanted = set(city_ids)
+    return {row[0]: row[1:] for row in db_cursor.fetchall() if row[0] in wanted}
+
+
+def _distance_km(lat1, lon1, lat2, lon2):
+    """Equirectangular approximation, accurate enough at station-matching distances."""
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371 * math.hypot(x, y)
+
+
+def group_into_tiles(city_coords, tile_degrees=TILE_DEGREES):
+    """Group {city_id: (lat, lon)} into {(tile_lat, tile_lon): [city_id, ...]}."""
+    tiles = {}
+    for city_id, (lat, lon) in city_coords.items():
+        key = (math.floor(lat / tile_degrees), math.floor(lon / tile_degrees))
+        tiles.setdefault(key, []).append(city_id)
+    return tiles
+
+
+def waqi_bounds_url(tile, tile_degrees=TILE_DEGREES, padding=TILE_PADDING):
+    lat1 = max(-90, tile[0] * tile_degrees - padding)
+    lng1 = max(-180, tile[1] * tile_degrees - padding)
+    lat2 = min(90, (tile[0] + 1) * tile_degrees + padding)
+    lng2 = min(180, (tile[1] + 1) * tile_degrees + padding)
+    return api_config.waqi_bounds_url(lat1, lng1, lat2, lng2)
+
+
+def owm_group_urls(owm_ids, group_size=OWM_GROUP_SIZE):
+    owm_ids = list(owm_ids)
+    return [api_config.owm_group_url(owm_ids[i:i + group_size]) for i in range(0, len(owm_ids), group_size)]
+
+
+def _station_city_data(city_id, station):
+    """Fan one WAQI map/bounds station out into an AqiRecord (no forecast is available)."""
+    try:
+        aqi = int(station.get('aqi'))
+    except (TypeError, ValueError):
+        aqi = None
+    station_time = (station.get('station') or {}).get('time')
+    return AqiRecord(city_id, waqi_observed_at({'time': {'iso': station_time}}), aqi, None, None, None, None)
+
+
+def match_stations(stations, city_ids, provider_ids, max_distance_km=MAX_STATION_DISTANCE_KM):
+    """Pick a station for each city: its known WAQI uid if present, else the nearest one in range."""
+    by_uid = {station.get('uid'): station for station in stations}
+    matched = {}
+    for city_id in city_ids:
+        _, waqi_uid, lat, lon = provider_ids[city_id]
+        if waqi_uid in by_uid:
+            matched[city_id] = by_uid[waqi_uid]
+            continue
+        best, best_distance = None, max_distance_km
+        for station in stations:
+            distance = _distance_km(lat, lon, station['lat'], station['lon'])
+            if distance <= best_distance:
+                best, best_distance = station, distance
+        if best is not None:
+            matched[city_id] = best
+    return matched
+
+
+def fetch_batched_city_data(db_cursor, batch, fetch=None):
+    """Fetch AQI and weather for a batch through the WAQI bounds and OpenWeatherMap group endpoints.
+
+    batch is a list of (city_id, name). Returns {city_id: parsers.CombinedRecord}
+    for every city both providers answered for. Cities whose provider ids are not
+    known yet, or that a batch response did not cover, are left out so the caller
+    can fall back to the per-city endpoints. `fetch` defaults to get_api_data and
+    can be replaced to replay recorded fixtures.
+    """
+    from file_functions import RATE_LIMITERS, get_api_data
+    fetch = fetch or get_api_data
+
+    def rate_limited_fetch(provider, url):
+        limiter = RATE_LIMITERS.get(provider)
+        if limiter is not None and not limiter.acquire():
+            return None
+        return fetch(url)
+
+    provider_ids = load_provider_ids(db_cursor, [city_id for city_id, _ in batch])
+    if not provider_ids:
+        return {}
+
+    weather_by_owm_id = {}
+    for url in owm_group_urls(ids[0] for ids in provider_ids.values()):
+        response = rate_limited_fetch('openweathermap', url)
+        for weather_data in (response or {}).get('list', []):
+            weather_by_owm_id[weather_data.get('id')] = weather_data
+
+    city_data = {}
+    coords = {city_id: ids[2:] for city_id, ids in provider_ids.items()}
+    for tile, city_ids in group_into_tiles(coords).items():
+        response = rate_limited_fetch('waqi', waqi_bounds_url(tile))
+        if not response or response.get('status') != 'ok':
+            continue
+        for city_id, station in match_stations(response['data'], city_ids, provider_ids).items():
+            city_data[city_id] = _station_city_data(city_id, station)
+
+    combined = {}
+    for city_id, (owm_id, _, _, _) in provider_ids.items():
+        weather = parse_owm_weather(city_id, weather_by_owm_id.get(owm_id))
+        if city_id in city_data and weather is not None:
+            combined[city_id] = CombinedRecord(city_data[city_id], weather)
+    return combined
+
+
+def fixture_fetch(fixture_dir):
+    """Return a fetch function that answers batch requests from recorded JSON files.
+
+    Bounds requests are served from waqi_map_bounds.json (stations are filtered to
+    the requested box) and group requests from owm_group.json (filtered to the
+    requested ids).
+    """
+    with open(os.path.join(fixture_dir, 'waqi_map_bounds.json'), 'r', encoding='utf-8') as f:
+        bounds = json.load(f)
+    with open(os.path.join(fixture_dir, 'owm_group.json'), 'r', encoding='utf-8') as f:
+        group = json.load(f)
+
+    def fetch(url):
+        query = parse_qs(urlsplit(url).query)
+        if 'latlng' in query:
+            lat1, lng1, lat2, lng2 = (float(value) for value in query['latlng'][0].split(','))
+            stations = [station for station in bounds['data']
+                        if lat1 <= station['lat'] <= lat2 and lng1 <= station['lon'] <= lng2]
+            return {'status': 'ok', 'data': stations}
+        if 'id' in query:
+            ids = {int(value) for value in query['id'][0].split(',')}
+            entries = [entry for entry in group['list'] if entry['id'] in ids]
+            return {'cnt': len(entries), 'list': entries}
+        return None
+
+    return fetch
+
+
+def check_fixtures(fixture_dir=FIXTURE_DIR):
+    """Replay the recorded batch responses through fetch_batched_city_data and check the parsed records.
+
+    Runs against an in-memory database seeded with FIXTURE_CITIES; raises
+    ValueError listing every city whose record differs from the expected one.
+    Returns the number of cities checked.
+    """
+    from db import connect_db
+    from file_functions import resolve_city_ids
+    from migrations import ensure_schema
+
+    connection = connect_db(':memory:')
+    try:
+        db_cursor = connection.cursor()
+        ensure_schema(db_cursor)
+        city_ids = resolve_city_ids(db_cursor, list(FIXTURE_CITIES))
+        record_provider_ids(db_cursor, [(city_ids[name], ids) for name, (ids, _) in FIXTURE_CITIES.items()])
+        combined = fetch_batched_city_data(db_cursor, [(city_id, name) for name, city_id in city_ids.items()],
+                                           fetch=fixture_fetch(fixture_dir))
+    finally:
+        connection.close()
+
+    problems = []
+    for name, (_, expected) in FIXTURE_CITIES.items():
+        record = combined.get(city_ids[name])
+        actual = None
+        if record is not None:
+            actual = (record.aqi.aqi, round(record.weather.temperature, 2), record.weather.humidity,
+                      record.weather.wind_speed)
+        if actual != expected:
+            problems.append(f"{name}: expected {expected}, got {actual}")
+    if problems:
+        raise ValueError("Fixture replay mismatch: " + '; '.join(problems))
+    return len(FIXTURE_CITIES)
+
+
+if __name__ == "__main__":
+    print(f"Replayed {check_fixtures()} fixture cities through the batch endpoints.")
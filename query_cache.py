@@ -0,0 +1,79 @@
+import glob
+import hashlib
+import os
+import threading
+
+import pandas as pd
+
+# Query results are pickled here, one file per (query name, data version)
+CACHE_DIR = 'query_cache'
+# Index-only probes whose results change with the inputs of the cached queries: the newest raw row ids
+# (inserts; ids are AUTOINCREMENT and never reused), the newest ingest batch (tells a recreated database
+# apart) and the city_observation_summary totals, which one row per city keeps cheap to read. A prune
+# rebuilds that summary, so the deleted observations change its counts.
+VERSION_QUERIES = (
+    'SELECT MAX(id) FROM city_aqi_data',
+    'SELECT MAX(id) FROM city_weather_data',
+    'SELECT id, started_at FROM ingest_batches ORDER BY id DESC LIMIT 1',
+    'SELECT COUNT(*), MAX(last_batch_id), SUM(observation_count) FROM city_observation_summary',
+)
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+
+def data_version(db_cursor, queries=VERSION_QUERIES):
+    """Short hash of the results of the version queries.
+
+    No query scans the raw tables: MAX(id) reads the end of the rowid b-tree.
+    A cached result stored under an older version is never returned.
+    """
+    parts = []
+    for query in queries:
+        db_cursor.execute(query)
+        parts.append(repr(db_cursor.fetchone()))
+    return hashlib.sha256(';'.join(parts).encode()).hexdigest()[:16]
+
+
+def _path(name, version, cache_dir):
+    return os.path.join(cache_dir, f'{name}-{version}.pkl')
+
+
+def cached_query(name, version, compute, cache_dir=CACHE_DIR):
+    """Return the DataFrame stored for (name, version), or compute(), store and return it.
+
+    Results of older versions of the same query are deleted when a new one is stored.
+    """
+    path = _path(name, version, cache_dir)
+    if os.path.exists(path):
+        with _lock:
+            _stats['hits'] += 1
+        return pd.read_pickle(path)
+    with _lock:
+        _stats['misses'] += 1
+    df = compute()
+    os.makedirs(cache_dir, exist_ok=True)
+    df.to_pickle(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    for stale in glob.glob(os.path.join(glob.escape(cache_dir), f'{glob.escape(name)}-*.pkl')):
+        if stale != path:
+            os.remove(stale)
+    return df
+
+
+def clear(cache_dir=CACHE_DIR):
+    """Delete every cached query result."""
+    for path in glob.glob(os.path.join(glob.escape(cache_dir), '*.pkl')):
+        os.remove(path)
+
+
+def get_stats():
+    """Return hit and miss counters."""
+    with _lock:
+        return dict(_stats)
+
+
+def format_stats():
+    """One-line human readable summary of get_stats()."""
+    stats = get_stats()
+    return f"Query cache: {stats['hits']} hits, {stats['misses']} misses"
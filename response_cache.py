@@ -0,0 +1,185 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from city_registry import fold_city_name
+from db import apply_pragmas
+from parsers import loads
+
+logger = logging.getLogger(__name__)
+
+# Stored next to global_combined_data.db
+CACHE_PATH = 'api_cache.db'
+# Seconds a payload stays fresh, per provider (WAQI stations update about hourly)
+PROVIDER_TTL = {'waqi': 3600, 'openweathermap': 600}
+DEFAULT_TTL = 600
+# Upper bound on every provider's TTL, set to the poll cadence so a poll is never answered from the previous one
+MAX_TTL = None
+# Least recently used entries are evicted beyond this many rows
+MAX_ENTRIES = 5000
+# Cache hits are written back as last_used updates in batches of this many
+TOUCH_BATCH = 100
+# Shared by the fetch threads and the sharded ingest worker processes; WAL lets readers skip the writer's lock
+PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}
+# Seconds to wait for another process's write before treating the lookup as a miss
+BUSY_TIMEOUT = 1.0
+
+_connection = None
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+# {(provider, city_key): last hit time} not yet written to the cache database
+_touched = {}
+
+
+def _get_connection():
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(CACHE_PATH, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        apply_pragmas(_connection, PRAGMAS)
+        _connection.execute('''
+        CREATE TABLE IF NOT EXISTS api_response_cache (
+            provider TEXT,
+            city_key TEXT,
+            payload TEXT,
+            fetched_at REAL,
+            last_used REAL,
+            PRIMARY KEY (provider, city_key)
+        )
+        ''')
+        _connection.execute('''
+        CREATE INDEX IF NOT EXISTS idx_api_response_cache_last_used ON api_response_cache (last_used)
+        ''')
+        _connection.commit()
+    return _connection
+
+
+def _write_touches(connection):
+    """Write the pending last_used updates of cache hits; the caller commits."""
+    if _touched:
+        connection.executemany('''
+        UPDATE api_response_cache SET last_used = ? WHERE provider = ? AND city_key = ?
+        ''', [(used, provider, key) for (provider, key), used in _touched.items()])
+        _touched.clear()
+
+
+def ttl(provider):
+    """Seconds a cached payload of `provider` stays fresh, capped at MAX_TTL."""
+    seconds = PROVIDER_TTL.get(provider, DEFAULT_TTL)
+    return seconds if MAX_TTL is None else min(seconds, MAX_TTL)
+
+
+def get(provider, city):
+    """Return the cached payload for (provider, city) if it is still fresh, else None.
+
+    Hits only record last_used in memory (written in batches, see
+    TOUCH_BATCH), and any cache database error counts as a miss.
+    """
+    key = fold_city_name(city)
+    now = time.time()
+    with _lock:
+        try:
+            connection = _get_connection()
+            row = connection.execute('''
+            SELECT payload, fetched_at FROM api_response_cache WHERE provider = ? AND city_key = ?
+            ''', (provider, key)).fetchone()
+            if row is not None and len(_touched) >= TOUCH_BATCH:
+                _write_touches(connection)
+                connection.commit()
+        except sqlite3.Error as e:
+            logger.warning("Response cache lookup failed, fetching instead: %s", e)
+            _touched.clear()
+            row = None
+        if row is None:
+            _stats['misses'] += 1
+            return None
+        payload, fetched_at = row
+        if now - fetched_at > ttl(provider):
+            _stats['expired'] += 1
+            _stats['misses'] += 1
+            return None
+        _touched[(provider, key)] = now
+        _stats['hits'] += 1
+    return loads(payload)
+
+
+def put(provider, city, payload):
+    """Store a payload for (provider, city) and evict the least recently used overflow.
+
+    A cache database error is logged and the payload is simply not cached.
+    """
+    now = time.time()
+    with _lock:
+        try:
+            connection = _get_connection()
+            _write_touches(connection)
+            connection.execute('''
+            INSERT OR REPLACE INTO api_response_cache (provider, city_key, payload, fetched_at, last_used)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (provider, fold_city_name(city), json.dumps(payload), now, now))
+            evicted = connection.execute('''
+            DELETE FROM api_response_cache WHERE rowid IN (
+                SELECT rowid FROM api_response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+            ''', (MAX_ENTRIES,)).rowcount
+            connection.commit()
+        except sqlite3.Error as e:
+            logger.warning("Could not store %s response for %s in the cache: %s", provider, city, e)
+            if _connection is not None and _connection.in_transaction:
+                _connection.rollback()
+            return
+        _stats['evictions'] += evicted
+
+
+def clear():
+    """Drop every cached payload."""
+    with _lock:
+        _touched.clear()
+        connection = _get_connection()
+        connection.execute('DELETE FROM api_response_cache')
+        connection.commit()
+
+
+def close():
+    """Write pending last_used updates and close the cache database."""
+    global _connection
+    with _lock:
+        if _connection is not None:
+            try:
+                _write_touches(_connection)
+                _connection.commit()
+            except sqlite3.Error as e:
+                logger.warning("Could not write response cache usage times: %s", e)
+            _connection.close()
+            _connection = None
+
+
+def get_stats():
+    """Return hit, miss, expiry and eviction counters."""
+    with _lock:
+        return dict(_stats)
+
+
+def drain_stats():
+    """Return the counters recorded since the last drain and clear them, for merge_stats in another process."""
+    with _lock:
+        drained = dict(_stats)
+        _stats.update(dict.fromkeys(_stats, 0))
+    return drained
+
+
+def merge_stats(drained):
+    """Add counters returned by drain_stats (e.g. in a worker process) to this process's."""
+    with _lock:
+        for key, value in drained.items():
+            _stats[key] += value
+
+
+def format_stats():
+    """One-line human readable summary of get_stats()."""
+    stats = get_stats()
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = stats['hits'] / lookups * 100 if lookups else 0.0
+    return (f"Cache: {stats['hits']} hits, {stats['misses']} misses ({hit_rate:.0f}% hit rate), "
+            f"{stats['expired']} expired, {stats['evictions']} evicted")
@@ -0,0 +1,143 @@
+import multiprocessing
+import os
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import api_config
+import http_client
+import instrumentation
+import provider_batch
+import response_cache
+import streaming
+from city_registry import COLLECTION_WINDOW, build_city_work_queue
+from file_functions import IngestWriter, build_combined_city_data, fetch_city_payloads, make_ingest_row
+
+# Cities a worker process fetches and parses per task
+CHUNK_SIZE = 100
+# Tasks queued per worker process ahead of the writer
+CHUNKS_IN_FLIGHT = 2
+
+# One single-process pool per shard, kept across batches (see shutdown_workers)
+_executors = []
+
+
+def shard_of(city, shards):
+    """Stable shard number of a city name: CRC-32 of its UTF-8 bytes modulo shards."""
+    return zlib.crc32(city.encode('utf-8')) % shards
+
+
+def partition(batch, shards):
+    """Split (city_id, name) pairs into `shards` lists by shard_of(name)."""
+    partitions = [[] for _ in range(shards)]
+    for city_id, city in batch:
+        partitions[shard_of(city, shards)].append((city_id, city))
+    return partitions
+
+
+def _init_worker(waqi_base_url, owm_base_url, cache_path, max_ttl, instrumented):
+    """Point a fresh worker process at the parent's providers and response cache."""
+    api_config.WAQI_BASE_URL = waqi_base_url
+    api_config.OWM_BASE_URL = owm_base_url
+    response_cache.CACHE_PATH = cache_path
+    response_cache.MAX_TTL = max_ttl
+    if instrumented:
+        instrumentation.enable()
+
+
+def _drain_worker_stats():
+    """HTTP, response cache and instrumentation counters recorded in this worker since the last chunk."""
+    return {'http': http_client.drain_stats(), 'response_cache': response_cache.drain_stats(),
+            'instrumentation': instrumentation.drain()}
+
+
+def _merge_worker_stats(stats):
+    """Add the counters a worker returned with a chunk to this process's, so run reports cover the workers."""
+    http_client.merge_stats(stats['http'])
+    response_cache.merge_stats(stats['response_cache'])
+    instrumentation.merge(stats['instrumentation'])
+
+
+def fetch_shard_chunk(cities, concurrency=None):
+    """Fetch and parse a chunk of (city_id, name) pairs in a worker process.
+
+    Returns (rows, stats): rows for file_functions.write_city_micro_batch and
+    this worker's counters for _merge_worker_stats. Decoding, unit conversion
+    and record building all happen here, off the writer's core, and only the
+    reduced rows of make_ingest_row are pickled back, never the raw payloads.
+    """
+    payloads = fetch_city_payloads([city for _, city in cities], concurrency)
+    rows = []
+    for city_id, city in cities:
+        aqi_data, weather_data = payloads[city]
+        rows.append(make_ingest_row(city_id, city, build_combined_city_data(city, city_id, aqi_data, weather_data),
+                                    aqi_data, weather_data))
+    return rows, _drain_worker_stats()
+
+
+def _get_executors(workers):
+    """Return one single-process pool per shard, (re)starting them when the worker count changes."""
+    if len(_executors) != workers:
+        shutdown_workers()
+        # spawn, not fork: the parent holds SQLite connections and HTTP sessions that must not be shared
+        context = multiprocessing.get_context('spawn')
+        initargs = (api_config.WAQI_BASE_URL, api_config.OWM_BASE_URL, os.path.abspath(response_cache.CACHE_PATH),
+                    response_cache.MAX_TTL, instrumentation.is_enabled())
+        _executors.extend(ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_init_worker,
+                                              initargs=initargs) for _ in range(workers))
+    return _executors
+
+
+def shutdown_workers():
+    """Stop the worker processes."""
+    while _executors:
+        _executors.pop().shutdown()
+
+
+@instrumentation.timed()
+def get_sharded_city_combined_data(city_requests, db_cursor, workers, batch_size=25, concurrency=None,
+                                   window_seconds=COLLECTION_WINDOW, batched=False, chunk_size=CHUNK_SIZE,
+                                   flush_rows=streaming.FLUSH_ROWS, flush_seconds=streaming.FLUSH_SECONDS):
+    """Like file_functions.get_multiple_city_combined_data, with fetching and parsing spread over processes.
+
+    The batch is hash-partitioned by city name into `workers` shards, each
+    served by its own worker process (see fetch_shard_chunk). This process is
+    the single writer: it applies the parsed chunks in micro-batches as they
+    arrive. concurrency limits requests per provider within each worker.
+    With batched=True the batch endpoints are queried here, as in the
+    single-process path, and only the remaining cities are sharded. Returns
+    (cities attempted, cities still due).
+    """
+    queue = build_city_work_queue(db_cursor, city_requests, window_seconds)
+    batch = queue[:batch_size]
+    batched_data = provider_batch.fetch_batched_city_data(db_cursor, batch) if batched else {}
+    executors = _get_executors(workers)
+    shards = partition([(city_id, city) for city_id, city in batch if city_id not in batched_data], workers)
+    chunks = [iter([shard[i:i + chunk_size] for i in range(0, len(shard), chunk_size)]) for shard in shards]
+    writer = IngestWriter(db_cursor, window_seconds)
+    pending = {}
+
+    def submit_next(shard):
+        chunk = next(chunks[shard], None)
+        if chunk:
+            pending[executors[shard].submit(fetch_shard_chunk, chunk, concurrency)] = shard
+
+    with streaming.MicroBatcher(writer, flush_rows, flush_seconds) as batcher:
+        for city_id, city in batch:
+            if city_id in batched_data:
+                batcher.add((city_id, city, batched_data[city_id], None, False))
+        for shard in range(workers):
+            for _ in range(CHUNKS_IN_FLIGHT):
+                submit_next(shard)
+        while pending:
+            done, _ = wait(pending, timeout=flush_seconds, return_when=FIRST_COMPLETED)
+            batcher.tick()
+            for future in done:
+                submit_next(pending.pop(future))
+                rows, stats = future.result()
+                _merge_worker_stats(stats)
+                for row in rows:
+                    batcher.add(row)
+
+    remaining = max(len(queue) - len(batch), 0)
+    writer.log_summary(len(batch), remaining, batcher.flushes, workers)
+    return len(batch), remaining
@@ -0,0 +1,100 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+# Results fetched ahead of the consumer (the bound on in-flight plus unconsumed work) per worker
+WINDOW_PER_WORKER = 2
+# A micro-batch is written once it holds this many rows ...
+FLUSH_ROWS = 200
+# ... or once its oldest row has waited this long
+FLUSH_SECONDS = 2.0
+# Returned by bounded_map when no result arrived within idle_timeout
+IDLE = object()
+
+
+def bounded_map(function, items, max_workers, window=None, idle_timeout=None):
+    """Yield (item, function(item)) for each item, in input order, computed on a thread pool.
+
+    At most `window` items (default max_workers * WINDOW_PER_WORKER) are in
+    flight or waiting for the consumer, and items are read from `items` only as
+    the window frees up, so memory stays flat however many items there are and
+    the consumer's work (e.g. DB writes) overlaps the workers'. When the next
+    result is not ready within idle_timeout seconds, IDLE is yielded so the
+    consumer can flush on time. Stopping the generator early cancels the
+    items not yet started.
+    """
+    window = window or max_workers * WINDOW_PER_WORKER
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        def submit_next():
+            for item in items:
+                pending.append((item, pool.submit(function, item)))
+                return
+
+        try:
+            for _ in range(window):
+                submit_next()
+            while pending:
+                item, future = pending[0]
+                try:
+                    result = future.result(timeout=idle_timeout)
+                except TimeoutError:
+                    yield IDLE
+                    continue
+                pending.popleft()
+                submit_next()
+                yield item, result
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+class MicroBatcher:
+    """Collect rows and hand them to `flush` in micro-batches.
+
+    A batch is flushed when it reaches max_rows, when tick() or add() finds its
+    oldest row older than max_seconds, and when the with-block exits. Rows are
+    not flushed again after flush itself raised.
+    """
+
+    def __init__(self, flush, max_rows=FLUSH_ROWS, max_seconds=FLUSH_SECONDS):
+        self._flush = flush
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.rows = []
+        self.flushes = 0
+        self._oldest = None
+        self._failed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self._failed:
+            self.flush()
+
+    def add(self, row):
+        if not self.rows:
+            self._oldest = time.monotonic()
+        self.rows.append(row)
+        if len(self.rows) >= self.max_rows:
+            self.flush()
+        else:
+            self.tick()
+
+    def tick(self):
+        """Flush if the oldest row has waited max_seconds."""
+        if self.rows and time.monotonic() - self._oldest >= self.max_seconds:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+        try:
+            self._flush(rows)
+        except BaseException:
+            self._failed = True
+            raise
+        self.flushes += 1
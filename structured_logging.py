@@ -0,0 +1,65 @@
+import json
+import logging
+import logging.handlers
+import sys
+import time
+
+# Records are held in memory and written in blocks of this many, or as soon as
+# one at FLUSH_LEVEL or above arrives
+BUFFER_CAPACITY = 1000
+FLUSH_LEVEL = logging.ERROR
+# Attributes every LogRecord has; anything else was passed through extra= and is emitted as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format each record as one JSON object: time, level, logger, message and any extra= fields."""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Plain "time level logger: message" lines with UTC timestamps."""
+    converter = time.gmtime
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)-7s %(name)s: %(message)s', '%Y-%m-%dT%H:%M:%SZ')
+
+
+def configure_logging(level='INFO', json_lines=False, log_file=None, capacity=BUFFER_CAPACITY):
+    """Send all log records through one buffered, level-filtered handler.
+
+    Records below `level` are dropped before they are formatted. The rest are
+    buffered by a MemoryHandler and written to `log_file` (stderr by default)
+    in blocks, as JSON lines or text. The buffer is flushed when it is full,
+    on any ERROR, on flush_logs() and at interpreter exit. Returns the handler.
+    """
+    target = logging.FileHandler(log_file, encoding='utf-8') if log_file else logging.StreamHandler(sys.stderr)
+    target.setFormatter(JsonLinesFormatter() if json_lines else TextFormatter())
+    handler = logging.handlers.MemoryHandler(capacity, flushLevel=FLUSH_LEVEL, target=target)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+        existing.close()
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    return handler
+
+
+def flush_logs():
+    """Write out any buffered records, e.g. between collector iterations."""
+    for handler in logging.getLogger().handlers:
+        handler.flush()
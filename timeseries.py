@@ -0,0 +1,185 @@
+import functools
+import time
+from datetime import datetime
+
+from calculations import discount_weather_rows, drop_unmatched_aggregates
+from db import unit_of_work
+
+# Raw observations older than this are deleted by prune_observations (None keeps them)
+RAW_RETENTION_DAYS = 90
+# Hourly rollups older than this are deleted; daily rollups are kept
+HOURLY_RETENTION_DAYS = 365
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+# (rollup table, bucket size in seconds) for each raw table
+ROLLUPS = {
+    'city_aqi_data': [('city_aqi_hourly', HOUR), ('city_aqi_daily', DAY)],
+    'city_weather_data': [('city_weather_hourly', HOUR), ('city_weather_daily', DAY)],
+}
+
+# The other half of each raw table's (city_id, batch_id) pairs
+PAIRED_SOURCE = {'city_aqi_data': 'city_weather_data', 'city_weather_data': 'city_aqi_data'}
+
+# Aggregate columns of each rollup, as (column name, SQL expression over the raw table)
+ROLLUP_COLUMNS = {
+    'city_aqi_data': [
+        ('aqi_avg', 'AVG(aqi)'),
+        ('aqi_max', 'MAX(aqi)'),
+        ('forecasted_pm25_avg', 'AVG(forecasted_pm25_avg)'),
+        ('forecasted_pm10_avg', 'AVG(forecasted_pm10_avg)'),
+        ('forecasted_o3_avg', 'AVG(forecasted_o3_avg)'),
+    ],
+    'city_weather_data': [
+        ('temperature_avg', 'AVG(temperature)'),
+        ('temperature_min', 'MIN(temperature)'),
+        ('temperature_max', 'MAX(temperature)'),
+        ('humidity_avg', 'AVG(humidity)'),
+        ('wind_speed_avg', 'AVG(wind_speed)'),
+    ],
+}
+
+
+def waqi_observed_at(aqi_data):
+    """Epoch seconds of a WAQI feed observation, from data.time.iso (or data.time.v)."""
+    observation_time = aqi_data.get('time')
+    if not isinstance(observation_time, dict):
+        observation_time = {}
+    iso = observation_time.get('iso')
+    if iso:
+        try:
+            return _iso_timestamp(iso)
+        except (TypeError, ValueError):
+            pass
+    try:
+        return int(observation_time['v'])
+    except (KeyError, TypeError, ValueError):
+        return int(time.time())
+
+
+# Stations report on the hour, so a batch of cities shares a handful of distinct iso strings
+@functools.lru_cache(maxsize=256)
+def _iso_timestamp(iso):
+    return int(datetime.fromisoformat(iso).timestamp())
+
+
+def owm_observed_at(weather_data):
+    """Epoch seconds of an OpenWeatherMap observation, from its 'dt' field."""
+    try:
+        return int(weather_data['dt'])
+    except (KeyError, TypeError, ValueError):
+        return int(time.time())
+
+
+def create_rollup_tables(db_cursor):
+    """Create the hourly and daily rollup tables, keyed by (city_id, bucket_ts)."""
+    for source, rollups in ROLLUPS.items():
+        columns = ', '.join(f'{name} REAL' for name, _ in ROLLUP_COLUMNS[source])
+        for table, _ in rollups:
+            db_cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                city_id INTEGER,
+                bucket_ts INTEGER,
+                samples INTEGER,
+                {columns},
+                PRIMARY KEY (city_id, bucket_ts)
+            ) WITHOUT ROWID
+            ''')
+    db_cursor.execute('''
+    CREATE TABLE IF NOT EXISTS rollup_watermarks (
+        source TEXT PRIMARY KEY,
+        last_id INTEGER
+    )
+    ''')
+
+
+def refresh_rollups(db_cursor):
+    """Recompute the rollup buckets touched by raw rows inserted since the last refresh."""
+    for source, rollups in ROLLUPS.items():
+        db_cursor.execute('SELECT last_id FROM rollup_watermarks WHERE source = ?', (source,))
+        row = db_cursor.fetchone()
+        last_id = row[0] if row else 0
+        db_cursor.execute(f'''
+        SELECT MIN(observed_at), MAX(id) FROM {source} WHERE id > ? AND observed_at IS NOT NULL
+        ''', (last_id,))
+        since, max_id = db_cursor.fetchone()
+        if max_id is None:
+            continue
+
+        names = ', '.join(name for name, _ in ROLLUP_COLUMNS[source])
+        expressions = ', '.join(expression for _, expression in ROLLUP_COLUMNS[source])
+        for table, bucket in rollups:
+            start = since - since % bucket
+            db_cursor.execute(f'''
+            INSERT OR REPLACE INTO {table} (city_id, bucket_ts, samples, {names})
+            SELECT city_id, observed_at - observed_at % {bucket}, COUNT(*), {expressions}
+            FROM {source}
+            WHERE observed_at >= ?
+            GROUP BY city_id, observed_at - observed_at % {bucket}
+            ''', (start,))
+        db_cursor.execute('''
+        INSERT OR REPLACE INTO rollup_watermarks (source, last_id) VALUES (?, ?)
+        ''', (source, max_id))
+
+
+def raw_cutoff(raw_retention_days=RAW_RETENTION_DAYS, now=None):
+    """Unix time before which raw observations are past retention."""
+    now = int(time.time()) if now is None else now
+    return now - raw_retention_days * DAY
+
+
+def prune_observations(db_cursor, raw_retention_days=RAW_RETENTION_DAYS,
+                       hourly_retention_days=HOURLY_RETENTION_DAYS, now=None):
+    """Roll up pending rows, then delete raw observations and hourly buckets past retention.
+
+    An AQI row and the weather row of the same (city_id, batch_id) are deleted
+    together, once the newer of the two is past retention; WAQI and
+    OpenWeatherMap observation times of one batch can be up to an hour apart.
+    Deleted weather rows are also taken out of the running averages (see
+    calculations.discount_weather_rows), so those always cover the retained
+    rows and agree with a --rebuild-averages run.
+    """
+    now = int(time.time()) if now is None else now
+    deleted = 0
+    with unit_of_work(db_cursor.connection):
+        refresh_rollups(db_cursor)
+        if raw_retention_days is not None:
+            cutoff = raw_cutoff(raw_retention_days, now)
+            for source, partner in PAIRED_SOURCE.items():
+                condition = f'''w.observed_at < :cutoff
+                  AND NOT EXISTS (SELECT 1 FROM {partner} p
+                                  WHERE p.city_id = w.city_id AND p.batch_id = w.batch_id
+                                    AND p.observed_at >= :cutoff)'''
+                if source == 'city_weather_data':
+                    discount_weather_rows(db_cursor, condition, {'cutoff': cutoff})
+                db_cursor.execute(f'DELETE FROM {source} AS w WHERE {condition}', {'cutoff': cutoff})
+                deleted += db_cursor.rowcount
+            if deleted:
+                drop_unmatched_aggregates(db_cursor)
+        if hourly_retention_days is not None:
+            cutoff = now - hourly_retention_days * DAY
+            for rollups in ROLLUPS.values():
+                for table, bucket in rollups:
+                    if bucket == HOUR:
+                        db_cursor.execute(f'DELETE FROM {table} WHERE bucket_ts < ?', (cutoff,))
+    return deleted
+
+
+def fetch_range(db_cursor, source, city_id, start_ts, end_ts, resolution=None):
+    """Return rows of a city between two epoch times from the raw table or a rollup.
+
+    resolution is None for raw observations, HOUR or DAY for the rollups.
+    """
+    if resolution is None:
+        db_cursor.execute(f'''
+        SELECT * FROM {source} WHERE city_id = ? AND observed_at >= ? AND observed_at < ?
+        ORDER BY observed_at
+        ''', (city_id, start_ts, end_ts))
+    else:
+        table = dict((bucket, name) for name, bucket in ROLLUPS[source])[resolution]
+        db_cursor.execute(f'''
+        SELECT * FROM {table} WHERE city_id = ? AND bucket_ts >= ? AND bucket_ts < ?
+        ORDER BY bucket_ts
+        ''', (city_id, start_ts, end_ts))
+    return db_cursor.fetchall()
@@ -1,11 +1,27 @@
-import sqlite3
+import hashlib
+import inspect
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # headless: plots are only ever written to files
 import matplotlib.pyplot as plt
 import seaborn as sns
-import os
-
-def connect_to_db(db_name='global_combined_data.db'):
-    conn = sqlite3.connect(db_name)
+import db
+from db import DB_PATH, connect_db
+import columnar_store
+import query_cache
+import instrumentation
+import time
+import analytics
+
+logger = logging.getLogger(__name__)
+
+def connect_to_db(db_name=DB_PATH):
+    # Plotting only reads, so it never takes the write lock
+    conn = connect_db(db_name, read_only=True)
     return conn
 
 def fetch_avg_temperature_data(db_cursor):
@@ -16,7 +32,10 @@ def fetch_avg_temperature_data(db_cursor):
     df = pd.read_sql_query(query, db_cursor.connection)
     return df
 
-def fetch_aqi_data(db_cursor):
+def fetch_aqi_data(db_cursor, snapshot_dir=columnar_store.SNAPSHOT_DIR):
+    # Read the typed Parquet snapshot when it is up to date, otherwise the SQLite join
+    if columnar_store.available() and columnar_store.snapshot_is_current(db_cursor, snapshot_dir):
+        return columnar_store.load_aqi_weather_frame(snapshot_dir)
     query = '''
     SELECT city_aqi_data.city_id, 
            aqi, 
@@ -28,19 +47,44 @@ def fetch_aqi_data(db_cursor):
            city_weather_data.temperature  -- Adding the temperature column
     FROM city_aqi_data
     JOIN city_weather_data ON city_aqi_data.city_id = city_weather_data.city_id
+                          AND city_aqi_data.batch_id = city_weather_data.batch_id
+    '''
+    df = pd.read_sql_query(query, db_cursor.connection)
+    return df
+
+def fetch_city_summary(db_cursor):
+    # Per-city averages materialized by calculations.refresh_observation_summary
+    query = '''
+    SELECT city_id,
+           avg_aqi AS aqi,
+           avg_forecasted_pm25 AS forecasted_pm25_avg,
+           avg_forecasted_pm10 AS forecasted_pm10_avg,
+           avg_forecasted_o3 AS forecasted_o3_avg
+    FROM city_observation_summary
+    ORDER BY city_id
     '''
     df = pd.read_sql_query(query, db_cursor.connection)
     return df
 
+def ensure_numeric(df, columns):
+    """Coerce columns to numbers, skipping ones that are already typed (e.g. from the snapshot)."""
+    for column in columns:
+        if not pd.api.types.is_numeric_dtype(df[column]):
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+
+PLOT_FOLDER = 'plots'
+# Input data hash of every rendered plot, kept next to the plots folder
+PLOT_MANIFEST = 'plots_manifest.json'
+
 def save_plot(plt, plot_name):
-    plot_folder = os.path.join(os.getcwd(), 'plots') #asked chatGPT how to make a relative path
+    plot_folder = os.path.join(os.getcwd(), PLOT_FOLDER) #asked chatGPT how to make a relative path
     if not os.path.exists(plot_folder):
         os.makedirs(plot_folder)
     file_path = os.path.join(plot_folder, f"{plot_name}.png")
 
     plt.savefig(file_path)
     plt.close()  
-    print(f"Plot saved as: {file_path}")
+    logger.debug("Plot saved as: %s", file_path)
 
 def plot_avg_temperature(df):
     plt.figure(figsize=(12, 6))
@@ -53,10 +97,8 @@ def plot_avg_temperature(df):
     save_plot(plt, 'average_temperature')
 
 def plot_aqi_heatmap(df):
-    """Plot a heatmap for AQI and pollutants (PM25, PM10, O3)."""
-    heatmap_data = df.pivot_table(index='city_id', 
-                                  values=['forecasted_pm25_avg', 'forecasted_pm10_avg', 'forecasted_o3_avg'],
-                                  aggfunc='mean')
+    """Plot a heatmap for AQI and pollutants (PM25, PM10, O3) from the per-city summary."""
+    heatmap_data = df.set_index('city_id')[['forecasted_o3_avg', 'forecasted_pm10_avg', 'forecasted_pm25_avg']]
     plt.figure(figsize=(10, 8))
     sns.heatmap(heatmap_data, annot=True, cmap='coolwarm', fmt=".1f")
     plt.title('Heatmap of AQI across Cities')
@@ -77,7 +119,7 @@ def plot_pollutant_comparison(df):
 
 
 def plot_temperature_distribution(df):
-    df['temperature'] = pd.to_numeric(df['temperature'], errors='coerce')
+    ensure_numeric(df, ['temperature'])
     df_clean = df.dropna(subset=['temperature'])
     plt.figure(figsize=(10, 6))
     sns.histplot(df_clean['temperature'], bins=30, kde=True, color='blue', alpha=0.7)
@@ -87,8 +129,7 @@ def plot_temperature_distribution(df):
     save_plot(plt, 'temperature_distribution')
 
 def plot_wind_speed_vs_aqi(df):
-    df['wind_speed'] = pd.to_numeric(df['wind_speed'], errors='coerce')
-    df['aqi'] = pd.to_numeric(df['aqi'], errors='coerce')
+    ensure_numeric(df, ['wind_speed', 'aqi'])
     df_clean = df.dropna(subset=['wind_speed', 'aqi'])
     plt.figure(figsize=(10, 6))
     sns.scatterplot(x='wind_speed', y='aqi', data=df_clean, color='purple', alpha=0.7)
@@ -98,7 +139,10 @@ def plot_wind_speed_vs_aqi(df):
     save_plot(plt, 'wind_speed_vs_aqi')
 
 def plot_correlation_heatmap(df):
-    df_corr = df[['aqi', 'forecasted_pm25_avg', 'forecasted_pm10_avg', 'forecasted_o3_avg', 'humidity', 'wind_speed', 'temperature']].corr()
+    columns = ['aqi', 'forecasted_pm25_avg', 'forecasted_pm10_avg', 'forecasted_o3_avg', 'humidity', 'wind_speed', 'temperature']
+    ensure_numeric(df, columns)
+    correlations, _ = analytics.correlation_matrix(df[columns].to_numpy(dtype=float))
+    df_corr = pd.DataFrame(correlations, index=columns, columns=columns)
     plt.figure(figsize=(10, 8))
     sns.heatmap(df_corr, annot=True, cmap='coolwarm', fmt=".2f", linewidths=0.5)
     plt.title('Correlation Heatmap of AQI and Weather Data')
@@ -113,22 +157,81 @@ def plot_aqi_boxplot(df):
     plt.xticks(rotation=90)
     save_plot(plt, 'aqi_boxplot')
 
-def main():
-    conn = connect_to_db()
-    cursor = conn.cursor()
-    df_avg_temp = fetch_avg_temperature_data(cursor)
-    plot_avg_temperature(df_avg_temp)
-    df_aqi = fetch_aqi_data(cursor)
-    plot_aqi_heatmap(df_aqi)
-    plot_pollutant_comparison(df_aqi)
-    plot_temperature_distribution(df_aqi)
-    plot_wind_speed_vs_aqi(df_aqi)
-    plot_correlation_heatmap(df_aqi)
-    plot_aqi_boxplot(df_aqi)
-
-    conn.close()
+# (file name, plot function, name of the dataframe it draws)
+PLOTS = [
+    ('average_temperature', plot_avg_temperature, 'avg_temperature'),
+    ('aqi_heatmap', plot_aqi_heatmap, 'city_summary'),
+    ('pollutant_comparison', plot_pollutant_comparison, 'aqi'),
+    ('temperature_distribution', plot_temperature_distribution, 'aqi'),
+    ('wind_speed_vs_aqi', plot_wind_speed_vs_aqi, 'aqi'),
+    ('correlation_heatmap', plot_correlation_heatmap, 'aqi'),
+    ('aqi_boxplot', plot_aqi_boxplot, 'aqi'),
+]
+
+def plot_input_hash(plot_function, df):
+    """Hash a plot's input data together with the plot's source, so either change re-renders it."""
+    digest = hashlib.sha256(inspect.getsource(plot_function).encode())
+    digest.update(','.join(map(str, df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+def load_plot_manifest(manifest_path=PLOT_MANIFEST):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def save_plot_manifest(manifest, manifest_path=PLOT_MANIFEST):
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def _render_plot(plot_function, df):
+    """Render one plot in a worker process and return its wall time (workers cannot record it themselves)."""
+    start = time.perf_counter()
+    plot_function(df)
+    return time.perf_counter() - start
+
+def render_plots(frames, max_workers=None, force=False, manifest_path=PLOT_MANIFEST):
+    """Render every plot whose input changed since the last run, in a process pool.
+
+    frames maps the dataframe names used in PLOTS to the loaded dataframes.
+    Returns the names of the plots that were rendered.
+    """
+    manifest = load_plot_manifest(manifest_path)
+    pending = {}
+    for plot_name, plot_function, frame_name in PLOTS:
+        input_hash = plot_input_hash(plot_function, frames[frame_name])
+        png_path = os.path.join(PLOT_FOLDER, f"{plot_name}.png")
+        if not force and manifest.get(plot_name) == input_hash and os.path.exists(png_path):
+            logger.debug("Plot %s is up to date, skipping.", plot_name)
+            continue
+        pending[plot_name] = (plot_function, frame_name, input_hash)
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {plot_name: pool.submit(_render_plot, plot_function, frames[frame_name])
+                       for plot_name, (plot_function, frame_name, _) in pending.items()}
+            for plot_name, future in futures.items():
+                instrumentation.record(f'visualizations.{pending[plot_name][0].__name__}', future.result())
+                manifest[plot_name] = pending[plot_name][2]
+        save_plot_manifest(manifest, manifest_path)
+    return list(pending)
+
+def main(max_workers=None, force=False, db_name=DB_PATH):
+    # Borrow a pooled read-only connection; WAL readers never block the writer
+    with db.read_pool(db_name).connection() as conn:
+        cursor = conn.cursor()
+        # The paired observations and the summary only change when data is ingested or pruned
+        version = query_cache.data_version(cursor)
+        frames = {
+            'avg_temperature': fetch_avg_temperature_data(cursor),
+            'aqi': query_cache.cached_query('aqi', version, lambda: fetch_aqi_data(cursor)),
+            'city_summary': query_cache.cached_query('city_summary', version, lambda: fetch_city_summary(cursor)),
+        }
+        cursor.close()
+    render_plots(frames, max_workers=max_workers, force=force)
 
 
 if __name__ == "__main__":
     main()
-